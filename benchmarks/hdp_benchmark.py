@@ -0,0 +1,105 @@
+"""
+Benchmarks the NumPy CPU implementation of the HDP mixture model against
+the flowstats GPU implementation on synthetic data.
+
+usage: python hdp_benchmark.py [cores] [gpu_device]
+
+The GPU run is skipped if flowstats or PyCUDA are not available.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'reflowworker'))
+
+from cpu_cluster import CPUDevice, HDPMixtureModel
+
+N_DATA_SETS = 4
+N_EVENTS = 10000
+N_DIM = 6
+N_TRUE_CLUSTERS = 8
+
+CLUSTER_COUNT = 32
+ITERATION_COUNT = 50
+BURN_IN = 100
+SEED = 123
+
+
+def make_data_sets():
+    """
+    Returns a list of data sets sampled from a shared set of Gaussian
+    clusters with different weights in each data set
+    """
+    rng = np.random.RandomState(0)
+    centers = rng.uniform(0, 10, (N_TRUE_CLUSTERS, N_DIM))
+    spreads = rng.uniform(0.2, 0.8, (N_TRUE_CLUSTERS, N_DIM))
+
+    data_sets = []
+    for i in range(N_DATA_SETS):
+        weights = rng.dirichlet(np.ones(N_TRUE_CLUSTERS) * 2)
+        labels = np.searchsorted(
+            np.cumsum(weights),
+            rng.random_sample(N_EVENTS)
+        )
+        labels = np.minimum(labels, N_TRUE_CLUSTERS - 1)
+        data_sets.append(
+            centers[labels] + rng.standard_normal((N_EVENTS, N_DIM)) *
+            spreads[labels]
+        )
+
+    return data_sets
+
+
+def run(model, data_sets, device):
+    start = time.time()
+    results = model.fit(data_sets, device, seed=SEED, munkres_id=False)
+    fit_time = time.time() - start
+
+    modal_mixture = results.average().make_modal()
+    events = [
+        np.bincount(
+            modal_mixture[i].classify(d),
+            minlength=len(modal_mixture.cmap)
+        )
+        for i, d in enumerate(data_sets)
+    ]
+    non_empty = np.sum(np.sum(events, axis=0) > 0)
+
+    return fit_time, len(modal_mixture.cmap), non_empty
+
+
+def main():
+    cores = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    gpu_device = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    data_sets = make_data_sets()
+    print "%d data sets, %d events x %d channels, %d true clusters" % (
+        N_DATA_SETS, N_EVENTS, N_DIM, N_TRUE_CLUSTERS
+    )
+    print "%-12s %10s %8s %10s" % ('backend', 'time (s)', 'modes', 'non-empty')
+
+    for n in sorted(set([1, cores])):
+        model = HDPMixtureModel(CLUSTER_COUNT, ITERATION_COUNT, BURN_IN)
+        fit_time, modes, non_empty = run(model, data_sets, CPUDevice(0, n))
+        print "%-12s %10.2f %8d %10d" % (
+            'cpu (%d)' % n, fit_time, modes, non_empty
+        )
+
+    try:
+        from flowstats import cluster
+    except ImportError:
+        print "flowstats not available, skipping GPU run"
+        return
+
+    model = cluster.HDPMixtureModel(CLUSTER_COUNT, ITERATION_COUNT, BURN_IN)
+    fit_time, modes, non_empty = run(model, data_sets, gpu_device)
+    print "%-12s %10.2f %8d %10d" % (
+        'gpu (%d)' % gpu_device, fit_time, modes, non_empty
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import numpy as np
 
+import cpu_cluster
+from cpu_cluster import CPUDevice
 from sample_models import Cluster, SampleCluster, \
     SampleClusterParameter, SampleClusterComponent, \
     SampleClusterComponentParameter
@@ -26,6 +28,28 @@ class ProgressCallable(object):
         return (iteration + self.burn_in + 1) * 100.0 / self.total_iter
 
 
+def preload_flowstats():
+    """
+    Imports flowstats ahead of time, so the cost of the import isn't paid
+    during the first call to hdp(). Like hdp(), this must only be called
+    after the Worker has daemonized.
+    """
+    from flowstats import cluster
+
+
+def create_device_context(device):
+    """
+    Creates a CUDA context on the given GPU device and makes it current.
+    Long-lived device processes create the context once and keep it for
+    all their ProcessRequests. The caller is responsible for detaching it.
+    """
+    import pycuda.driver as cuda
+
+    cuda.init()
+
+    return cuda.Device(device).make_context()
+
+
 def hdp(process_request, device):
     iteration_count = int(process_request.clustering_options['iteration_count'])
     cluster_count = int(process_request.clustering_options['cluster_count'])
@@ -45,9 +69,13 @@ def hdp(process_request, device):
         # nothing for us to do
         raise ValueError("Data set list is empty")
 
-    # NOTE: we import this here to avoid a PyCUDA issue when starting up
-    # the daemonize procedure
-    from flowstats import cluster
+    if isinstance(device, CPUDevice):
+        # no GPU, use the NumPy implementation with the same interface
+        cluster = cpu_cluster
+    else:
+        # NOTE: we import this here to avoid a PyCUDA issue when starting up
+        # the daemonize procedure
+        from flowstats import cluster
 
     progress_callable = ProgressCallable(
         process_request,
@@ -108,43 +136,36 @@ def hdp(process_request, device):
             classifications = modal_mixture.classify(data_sets[i])
 
         # Grab events from transformed data set b/c the normalized data
-        # doesn't have all columns.
-        # transformed data already has the original index in 1st column
+        # doesn't have all columns, and add the event's original index
+        # (as 1st column)
         x_data = np.load(sample.preprocessed_path)
+        events = np.hstack(
+            [np.reshape(sample.subsample_indices, (-1, 1)), x_data]
+        )
 
-        # Group event indices by the modal mixture mode for this sample.
-        # event_map holds the event data plus the event's index (as 1st column)
-        # for each mode. the first row for each map contains the header row
+        # Group events by the modal mixture mode for this sample.
+        # A stable sort keeps the events of each mode in their original
+        # order, and each mode's events are then a contiguous block.
+        # event_map holds the events (w/ index in 1st column) for each mode
+        order = np.argsort(classifications, kind='mergesort')
+        event_classes, starts = np.unique(
+            classifications[order],
+            return_index=True
+        )
         event_map = dict()
-        for j, event_class in enumerate(classifications):
-            if event_class not in event_map:
-                # create a new map for this sample cluster w/ header row
-                header_row = ['event_index']
-                header_row.extend(
-                    range(1, x_data.shape[1] + 1)
-                )
-                event_map[event_class] = [header_row]  # a list of lists
-
-            # grab event from transformed data, and add to map.
-            # Make sure to convert any numpy-ish stuff to int and float,
-            # else we risk errors when encoding to JSON later
-            event_row = x_data[j].tolist()
-            event_row.insert(0, int(sample.subsample_indices[j]))
-            event_map[event_class].append(event_row)
+        for event_class, block in zip(
+                event_classes,
+                np.split(order, starts[1:])):
+            event_map[event_class] = events[block]
 
         # So we captured all the classified events in the event map, but
         # there may be clusters for which this sample has no events. We need
         # to catch these 0 event sample clusters, otherwise a ReFlow user
         # may not even know about the existence of them unless they looked
         # carefully at each sample's results
-        zero_clusters = set(modal_mixture.cmap.keys()) - set(np.unique(classifications))
+        zero_clusters = set(modal_mixture.cmap.keys()) - set(event_classes)
         for event_class in zero_clusters:
-            # create a new map for this sample cluster w/ header row
-            header_row = ['event_index']
-            header_row.extend(
-                range(1, x_data.shape[1] + 1)
-            )
-            event_map[event_class] = [header_row]  # a list of lists
+            event_map[event_class] = np.empty((0, events.shape[1]))
 
         # now we have all the events for this sample classified and organized
         # by cluster, so we can start creating the SampleCluster instances
@@ -196,7 +217,7 @@ def hdp(process_request, device):
             if data_sets[i].shape[0] == 0:
                 event_percentage = 0.0  # avoid divide by zero
             else:
-                event_percentage = (len(event_map[event_class]) - 1) / float(data_sets[i].shape[0]) * 100.0
+                event_percentage = len(event_map[event_class]) / float(data_sets[i].shape[0]) * 100.0
 
             clusters[event_class].add_sample_cluster(
                 SampleCluster(
@@ -0,0 +1,556 @@
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+# NOTE: This is a pure NumPy implementation of the flowstats DP & HDP
+#       Gaussian mixture models, used to run clustering on CPU-only
+#       devices. The model classes and their results mimic the flowstats
+#       interface (fit(), average(), make_modal()) so hdp() can treat both
+#       the same. The heavy lifting is done in BLAS calls, which release
+#       the GIL, so the work is split across a thread pool.
+
+
+class CPUDevice(object):
+    """
+    A group of CPU cores used in place of a GPU device. The Worker treats
+    CPU devices like any other device, and hdp() will use the NumPy
+    implementation to run the clustering on them.
+    """
+    def __init__(self, index, cores):
+        self.index = index
+        self.cores = cores
+
+    def __str__(self):
+        return "cpu%d" % self.index
+
+    def __repr__(self):
+        return "CPUDevice(%d, %d)" % (self.index, self.cores)
+
+    def __eq__(self, other):
+        return isinstance(other, CPUDevice) and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(('cpu', self.index))
+
+
+def _log_densities(x, mus, chol_precisions, log_norms):
+    """
+    Returns (events x components) array of the log density of each event
+    for each Gaussian component, given the Cholesky factors of the
+    component precision matrices
+    """
+    log_dens = np.empty((x.shape[0], mus.shape[0]))
+
+    for k in range(mus.shape[0]):
+        y = np.dot(x - mus[k], chol_precisions[k])
+        log_dens[:, k] = -0.5 * np.sum(y * y, axis=1)
+
+    log_dens += log_norms
+
+    return log_dens
+
+
+def _precision_factors(sigmas):
+    """
+    Returns the Cholesky factors of the precision matrices and the log
+    normalizing constants for the given covariance matrices
+    """
+    n_dim = sigmas.shape[1]
+    chol_precisions = np.empty_like(sigmas)
+    log_norms = np.empty(sigmas.shape[0])
+
+    for k in range(sigmas.shape[0]):
+        chol_precisions[k] = np.linalg.cholesky(np.linalg.inv(sigmas[k]))
+        log_norms[k] = np.sum(np.log(np.diag(chol_precisions[k]))) - \
+            0.5 * n_dim * np.log(2 * np.pi)
+
+    return chol_precisions, log_norms
+
+
+def _classify(x, log_weights, mus, sigmas):
+    """
+    Returns the index of the most probable component for each event
+    """
+    chol_precisions, log_norms = _precision_factors(sigmas)
+    log_dens = _log_densities(x, mus, chol_precisions, log_norms)
+
+    return np.argmax(log_dens + log_weights, axis=1)
+
+
+def _logsumexp(a):
+    """
+    Returns the log of the sum of exp(a) along the 2nd axis, without
+    overflow or underflow
+    """
+    a_max = a.max(axis=1)
+    a_max[~np.isfinite(a_max)] = 0.0
+
+    return np.log(np.sum(np.exp(a - a_max[:, np.newaxis]), axis=1)) + a_max
+
+
+def _sample_assignments(x, log_weights, uniforms, mus, chol_precs, log_norms):
+    """
+    Draws a component for each event from its posterior probabilities
+    using inverse CDF sampling with the given uniform random numbers
+    """
+    log_prob = _log_densities(x, mus, chol_precs, log_norms) + log_weights
+    log_prob -= log_prob.max(axis=1)[:, np.newaxis]
+    cdf = np.cumsum(np.exp(log_prob), axis=1)
+
+    assignments = np.sum(
+        cdf < (uniforms * cdf[:, -1])[:, np.newaxis],
+        axis=1
+    )
+
+    return np.minimum(assignments, mus.shape[0] - 1)
+
+
+def _sample_inv_wishart(rng, df, scale):
+    """
+    Draws a covariance matrix from an inverse Wishart distribution using
+    the Bartlett decomposition of the corresponding Wishart distribution
+    """
+    n_dim = scale.shape[0]
+    chol = np.linalg.cholesky(np.linalg.inv(scale))
+
+    a = np.zeros((n_dim, n_dim))
+    a[np.diag_indices(n_dim)] = np.sqrt(rng.chisquare(df - np.arange(n_dim)))
+    a[np.tril_indices(n_dim, -1)] = rng.standard_normal(
+        n_dim * (n_dim - 1) // 2
+    )
+
+    la = np.dot(chol, a)
+    sigma = np.linalg.inv(np.dot(la, la.T))
+
+    return (sigma + sigma.T) / 2.0
+
+
+def _sample_stick_weights(rng, counts, alpha):
+    """
+    Draws truncated stick-breaking weights given the component counts
+    """
+    remaining = np.cumsum(counts[::-1])[::-1]
+    remaining = np.append(remaining[1:], 0)
+
+    v = rng.beta(1.0 + counts[:-1], alpha + remaining[:-1])
+    v = np.append(v, 1.0)
+
+    weights = v * np.append(1.0, np.cumprod(1.0 - v[:-1]))
+
+    return weights
+
+
+def _sample_dirichlet(rng, alphas):
+    """
+    Draws from a Dirichlet distribution, tolerating parameters that
+    have underflowed to zero
+    """
+    draws = rng.gamma(np.maximum(alphas, 1e-10))
+    draws = np.maximum(draws, 1e-300)
+
+    return draws / draws.sum()
+
+
+def _sample_table_counts(rng, counts, concentrations):
+    """
+    Draws the number of tables for each (data set, component) from the
+    Chinese restaurant franchise (Antoniak distribution), given the
+    number of events & the concentration parameter for each
+    """
+    flat_counts = counts.ravel()
+    total = flat_counts.sum()
+
+    owner = np.repeat(np.arange(flat_counts.size), flat_counts)
+    starts = np.repeat(np.cumsum(flat_counts) - flat_counts, flat_counts)
+    position = np.arange(total) - starts
+
+    c = concentrations.ravel()[owner]
+    is_new_table = rng.random_sample(total) < c / (c + position)
+
+    tables = np.bincount(
+        owner,
+        weights=is_new_table,
+        minlength=flat_counts.size
+    )
+
+    return tables.reshape(counts.shape)
+
+
+def _fit(
+        data_sets,
+        n_clusters,
+        n_iterations,
+        burn_in,
+        alpha,
+        gamma,
+        device,
+        seed,
+        callback,
+        hierarchical):
+    """
+    Blocked Gibbs sampler for the truncated DP (single data set) or
+    weak-limit HDP (multiple data sets) Gaussian mixture with a
+    normal-inverse-Wishart prior. Returns a MixtureResults instance
+    with the draws after burn-in.
+    """
+    rng = np.random.RandomState()
+    rng.seed(seed)
+
+    if isinstance(device, CPUDevice):
+        cores = device.cores
+    else:
+        cores = 1
+
+    # standardize the pooled data, the prior is specified on this scale
+    x = np.vstack(data_sets).astype(np.float64)
+    data_set_ids = np.repeat(
+        np.arange(len(data_sets)),
+        [len(d) for d in data_sets]
+    )
+    n_events, n_dim = x.shape
+    n_data_sets = len(data_sets)
+
+    shift = x.mean(axis=0)
+    scale = x.std(axis=0)
+    scale[scale == 0] = 1.0
+    x = (x - shift) / scale
+
+    # normal-inverse-Wishart prior
+    kappa_0 = 0.01
+    nu_0 = n_dim + 2.0
+    psi_0 = np.eye(n_dim) * 0.1
+
+    # initialize the components at random events w/ unit covariance
+    # (the same draws as rng.choice(), which needs NumPy 1.7)
+    if n_events >= n_clusters:
+        mus = x[rng.permutation(n_events)[:n_clusters]]
+    else:
+        mus = x[rng.randint(0, n_events, n_clusters)]
+    sigmas = np.tile(np.eye(n_dim), (n_clusters, 1, 1))
+    pis = np.tile(np.ones(n_clusters) / n_clusters, (n_data_sets, 1))
+    beta = np.ones(n_clusters) / n_clusters
+
+    trace_pis = np.empty((n_iterations, n_data_sets, n_clusters))
+    trace_mus = np.empty((n_iterations, n_clusters, n_dim))
+    trace_sigmas = np.empty((n_iterations, n_clusters, n_dim, n_dim))
+
+    # event chunks handed to the thread pool
+    bounds = np.linspace(0, n_events, cores + 1).astype(np.int64)
+    chunks = [(bounds[i], bounds[i + 1]) for i in range(cores)]
+
+    pool = ThreadPool(cores)
+
+    try:
+        for t in range(burn_in + n_iterations):
+            # Assign events to components
+            chol_precs, log_norms = _precision_factors(sigmas)
+            log_pis = np.log(np.maximum(pis, 1e-300))
+            # draw all random numbers up front, so results don't depend
+            # on the number of cores
+            uniforms = rng.random_sample(n_events)
+
+            def assign(chunk):
+                start, end = chunk
+                return _sample_assignments(
+                    x[start:end],
+                    log_pis[data_set_ids[start:end]],
+                    uniforms[start:end],
+                    mus,
+                    chol_precs,
+                    log_norms
+                )
+
+            z = np.concatenate(pool.map(assign, chunks))
+
+            counts = np.bincount(
+                data_set_ids * n_clusters + z,
+                minlength=n_data_sets * n_clusters
+            ).reshape(n_data_sets, n_clusters)
+
+            # Sample the mixture weights
+            if hierarchical:
+                tables = _sample_table_counts(
+                    rng,
+                    counts,
+                    np.tile(alpha * beta, (n_data_sets, 1))
+                )
+                beta = _sample_dirichlet(
+                    rng,
+                    gamma / n_clusters + tables.sum(axis=0)
+                )
+                for j in range(n_data_sets):
+                    pis[j] = _sample_dirichlet(rng, alpha * beta + counts[j])
+            else:
+                pis[0] = _sample_stick_weights(rng, counts[0], alpha)
+
+            # Sample the component parameters from the NIW posterior
+            order = np.argsort(z, kind='mergesort')
+            ends = np.cumsum(counts.sum(axis=0))
+            starts = ends - counts.sum(axis=0)
+
+            def scatter(k):
+                x_k = x[order[starts[k]:ends[k]]]
+                if len(x_k) == 0:
+                    return np.zeros(n_dim), np.zeros((n_dim, n_dim))
+                x_bar = x_k.mean(axis=0)
+                x_c = x_k - x_bar
+                return x_bar, np.dot(x_c.T, x_c)
+
+            stats = pool.map(scatter, range(n_clusters))
+
+            for k in range(n_clusters):
+                n_k = ends[k] - starts[k]
+                x_bar, s_k = stats[k]
+
+                kappa_n = kappa_0 + n_k
+                nu_n = nu_0 + n_k
+                m_n = n_k * x_bar / kappa_n
+                psi_n = psi_0 + s_k + \
+                    (kappa_0 * n_k / kappa_n) * np.outer(x_bar, x_bar)
+
+                sigmas[k] = _sample_inv_wishart(rng, nu_n, psi_n)
+                mus[k] = m_n + np.dot(
+                    np.linalg.cholesky(sigmas[k] / kappa_n),
+                    rng.standard_normal(n_dim)
+                )
+
+            if t >= burn_in:
+                # save the draw on the original data scale
+                trace_pis[t - burn_in] = pis
+                trace_mus[t - burn_in] = mus * scale + shift
+                trace_sigmas[t - burn_in] = sigmas * np.outer(scale, scale)
+
+            if callback is not None:
+                # like flowstats, burn-in iterations are negative
+                callback(t - burn_in)
+    finally:
+        pool.close()
+        pool.join()
+
+    return MixtureResults(trace_pis, trace_mus, trace_sigmas)
+
+
+class DPMixtureModel(object):
+    """
+    Truncated Dirichlet process Gaussian mixture for a single data set,
+    with the same interface as flowstats.cluster.DPMixtureModel
+    """
+    def __init__(self, n_clusters, n_iterations, burn_in, model='dp'):
+        if model != 'dp':
+            raise ValueError("Only the 'dp' model is supported on CPU")
+
+        self.n_clusters = n_clusters
+        self.n_iterations = n_iterations
+        self.burn_in = burn_in
+        self.alpha = 1.0
+
+    def fit(
+            self,
+            data,
+            device,
+            seed=None,
+            munkres_id=False,
+            verbose=False,
+            callback=None):
+        if munkres_id:
+            raise ValueError("Label identification is not supported on CPU")
+
+        return _fit(
+            [data],
+            self.n_clusters,
+            self.n_iterations,
+            self.burn_in,
+            self.alpha,
+            None,
+            device,
+            seed,
+            callback,
+            hierarchical=False
+        )
+
+
+class HDPMixtureModel(object):
+    """
+    Hierarchical Dirichlet process Gaussian mixture for multiple data sets
+    sharing components, with the same interface as
+    flowstats.cluster.HDPMixtureModel
+    """
+    def __init__(self, n_clusters, n_iterations, burn_in):
+        self.n_clusters = n_clusters
+        self.n_iterations = n_iterations
+        self.burn_in = burn_in
+        self.alpha = 1.0
+        self.gamma = 1.0
+
+    def fit(
+            self,
+            data_sets,
+            device,
+            seed=None,
+            munkres_id=False,
+            verbose=False,
+            callback=None):
+        if munkres_id:
+            raise ValueError("Label identification is not supported on CPU")
+
+        return _fit(
+            data_sets,
+            self.n_clusters,
+            self.n_iterations,
+            self.burn_in,
+            self.alpha,
+            self.gamma,
+            device,
+            seed,
+            callback,
+            hierarchical=True
+        )
+
+
+class MixtureResults(object):
+    """
+    The posterior draws after burn-in. pis has a row of component weights
+    for each data set.
+    """
+    def __init__(self, pis, mus, sigmas):
+        self.pis = pis
+        self.mus = mus
+        self.sigmas = sigmas
+
+    def average(self):
+        """
+        Returns the Mixture of the averaged draws. Like flowstats with
+        munkres_id=False, the component labels are not re-identified
+        between iterations.
+        """
+        return Mixture(
+            self.pis.mean(axis=0),
+            self.mus.mean(axis=0),
+            self.sigmas.mean(axis=0)
+        )
+
+
+class Mixture(object):
+    """
+    Gaussian mixture with components shared between data sets, and a row
+    of component weights (pis) for each data set
+    """
+    def __init__(self, pis, mus, sigmas):
+        self.pis = pis
+        self.mus = mus
+        self.sigmas = sigmas
+
+    def classify(self, x):
+        """
+        Returns the most probable component for each event, using the
+        first data set's weights
+        """
+        return _classify(
+            x,
+            np.log(np.maximum(self.pis[0], 1e-300)),
+            self.mus,
+            self.sigmas
+        )
+
+    def make_modal(self, tol=1e-2, max_iterations=100):
+        """
+        Returns a ModalMixture where components sharing a mode of the
+        mixture density are merged. Each component is moved uphill to its
+        mode using a fixed point iteration, with the weights averaged over
+        all data sets. Modes closer than tol, in units of the mixture's
+        standard deviation, are considered the same.
+        """
+        weights = self.pis.mean(axis=0)
+        log_weights = np.log(np.maximum(weights, 1e-300))
+
+        chol_precs, log_norms = _precision_factors(self.sigmas)
+        precisions = np.einsum('kij,klj->kil', chol_precs, chol_precs)
+        precision_mus = np.einsum('kij,kj->ki', precisions, self.mus)
+
+        overall_mean = np.dot(weights, self.mus)
+        overall_var = np.dot(
+            weights,
+            np.diagonal(self.sigmas, axis1=1, axis2=2) +
+            (self.mus - overall_mean) ** 2
+        )
+        scale = np.sqrt(overall_var)
+        scale[scale == 0] = 1.0
+
+        # move every component's location uphill simultaneously
+        points = self.mus.copy()
+        for i in range(max_iterations):
+            log_r = _log_densities(points, self.mus, chol_precs, log_norms) \
+                + log_weights
+            log_r -= log_r.max(axis=1)[:, np.newaxis]
+            r = np.exp(log_r)
+
+            a = np.einsum('sk,kij->sij', r, precisions)
+            b = np.einsum('sk,ki->si', r, precision_mus)
+            # solved per component, stacked solve() needs NumPy 1.8
+            new_points = np.array(
+                [np.linalg.solve(a[s], b[s]) for s in range(len(points))]
+            )
+
+            shift = np.abs((new_points - points) / scale).max()
+            points = new_points
+            if shift < tol * 1e-3:
+                break
+
+        # group components by their mode
+        modes = dict()
+        cmap = dict()
+        for k in range(len(points)):
+            for m in modes:
+                if np.abs((points[k] - modes[m]) / scale).max() < tol:
+                    cmap[m].append(k)
+                    break
+            else:
+                m = len(modes)
+                modes[m] = points[k]
+                cmap[m] = [k]
+
+        return ModalMixture(self.pis, self.mus, self.sigmas, cmap, modes)
+
+
+class ModalMixture(Mixture):
+    """
+    Mixture whose components are grouped by mode. cmap maps each mode
+    index to its list of component indices, and modes maps each mode
+    index to its location. Indexing returns the ModalMixture for a single
+    data set, and classify() returns mode indices.
+    """
+    def __init__(self, pis, mus, sigmas, cmap, modes):
+        super(ModalMixture, self).__init__(pis, mus, sigmas)
+        self.cmap = cmap
+        self.modes = modes
+
+    def __getitem__(self, data_set):
+        return ModalMixture(
+            self.pis[data_set:data_set + 1],
+            self.mus,
+            self.sigmas,
+            self.cmap,
+            self.modes
+        )
+
+    def __len__(self):
+        return len(self.pis)
+
+    def classify(self, x):
+        """
+        Returns the most probable mode for each event, using the first data
+        set's weights. Like flowstats, a mode's probability is the sum of
+        the weighted densities of all its components.
+        """
+        chol_precisions, log_norms = _precision_factors(self.sigmas)
+        log_prob = _log_densities(x, self.mus, chol_precisions, log_norms) \
+            + np.log(np.maximum(self.pis[0], 1e-300))
+
+        mode_log_prob = np.empty((x.shape[0], len(self.cmap)))
+        for m in range(len(self.cmap)):
+            mode_log_prob[:, m] = _logsumexp(log_prob[:, self.cmap[m]])
+
+        return np.argmax(mode_log_prob, axis=1)
@@ -0,0 +1,149 @@
+import numpy as np
+
+# NOTE: Don't attempt to log or catch exceptions here, ProcessRequest will
+#       handle any exceptions thrown.
+
+# The HEADER segment is 58 bytes: the version, 4 spaces, then byte offsets
+# for the TEXT, DATA, & ANALYSIS segments as 8 character ASCII integers
+HEADER_SIZE = 58
+
+
+class FCSHeader(object):
+    """
+    The metadata of an FCS file, read from the HEADER and TEXT segments
+    only, without touching the event data. Keys of the 'text' dictionary
+    are upper case, e.g. '$TOT'.
+    """
+    def __init__(self, file_path):
+        fcs_file = open(file_path, 'rb')
+        try:
+            header = fcs_file.read(HEADER_SIZE)
+            self.version = header[0:6]
+            if not self.version.startswith('FCS'):
+                raise ValueError("%s is not an FCS file" % file_path)
+
+            text_start = int(header[10:18])
+            text_end = int(header[18:26])
+            data_start = int(header[26:34])
+            data_end = int(header[34:42])
+
+            fcs_file.seek(text_start)
+            self.text = _parse_text(fcs_file.read(text_end - text_start + 1))
+        finally:
+            fcs_file.close()
+
+        # Offsets too large for the HEADER are only given in the TEXT
+        if data_start == 0 and data_end == 0:
+            data_start = int(self.text['$BEGINDATA'])
+            data_end = int(self.text['$ENDDATA'])
+
+        # DATA segment byte offsets, the end offset is inclusive
+        self.data_start = data_start
+        self.data_end = data_end
+
+        self.event_count = int(self.text['$TOT'])
+        self.channel_count = int(self.text['$PAR'])
+
+        # 'I' (integer), 'F' (float), 'D' (double), or 'A' (ASCII)
+        self.datatype = self.text['$DATATYPE'].upper()
+
+        # 1,2,3,4 is little endian, 4,3,2,1 is big endian
+        if self.text['$BYTEORD'].strip().startswith('1'):
+            self.byte_order = '<'
+        else:
+            self.byte_order = '>'
+
+        # bits per channel value, '*' is used for ASCII data
+        self.bit_widths = list()
+        for i in range(1, self.channel_count + 1):
+            bits = self.text['$P%dB' % i].strip()
+            self.bit_widths.append(None if bits == '*' else int(bits))
+
+        self.mode = self.text.get('$MODE', 'L').upper()
+
+    def get_data_dtype(self):
+        """
+        Returns the NumPy dtype of the values stored in the DATA segment, or
+        None if the layout can't be mapped directly to an array (ASCII data,
+        mixed integer bit widths, or non-list mode data)
+        """
+        if self.mode != 'L':
+            return None
+
+        if self.datatype == 'F':
+            type_code = 'f4'
+        elif self.datatype == 'D':
+            type_code = 'f8'
+        elif self.datatype == 'I' and len(set(self.bit_widths)) == 1 and \
+                self.bit_widths[0] in [8, 16, 32]:
+            # unsigned and un-masked, same as flowio for uniform bit widths
+            type_code = 'u%d' % (self.bit_widths[0] / 8)
+        else:
+            return None
+
+        return np.dtype(self.byte_order + type_code)
+
+    def get_event_dtype(self):
+        """
+        Returns the dtype flowio produces for the events, 64-bit integers
+        for integer data, otherwise 64-bit floats
+        """
+        if self.datatype == 'I':
+            return np.dtype(np.int64)
+
+        return np.dtype(np.float64)
+
+    def map_events(self, file_path):
+        """
+        Returns a read-only (events x channels) np.memmap of the DATA segment
+        without reading or copying the event data, or None if the DATA
+        segment can't be mapped (see get_data_dtype).
+        """
+        dtype = self.get_data_dtype()
+        if dtype is None:
+            return None
+
+        data_size = self.data_end - self.data_start + 1
+        if data_size % dtype.itemsize == 1:
+            # Like flowio, tolerate the common error of an end offset
+            # that is exclusive rather than inclusive
+            data_size -= 1
+        if data_size % dtype.itemsize != 0:
+            raise ValueError(
+                "Unable to determine the correct byte offsets for event data"
+            )
+
+        event_count = data_size / dtype.itemsize / self.channel_count
+
+        return np.memmap(
+            file_path,
+            dtype=dtype,
+            mode='r',
+            offset=self.data_start,
+            shape=(event_count, self.channel_count)
+        )
+
+
+def _parse_text(text):
+    """
+    Parses the TEXT segment into a dictionary. The 1st character is the
+    delimiter, and a doubled delimiter is an escaped delimiter within a
+    keyword or value.
+    """
+    delimiter = text[0]
+    body = text[1:]
+    if body.endswith(delimiter):
+        body = body[:-1]
+
+    # FCS doesn't allow empty values, so a doubled delimiter is always an
+    # escape. Swap them out before splitting.
+    placeholder = '\0'
+    fields = body.replace(delimiter * 2, placeholder).split(delimiter)
+    fields = [f.replace(placeholder, delimiter) for f in fields]
+
+    text_dict = dict()
+    for i in range(0, len(fields) - 1, 2):
+        text_dict[fields[i].strip().upper()] = fields[i + 1]
+
+    return text_dict
+
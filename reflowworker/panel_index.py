@@ -0,0 +1,72 @@
+# NOTE: Don't attempt to log or catch exceptions here, ProcessRequest will
+#       handle any exceptions thrown.
+
+SCATTER_TYPES = ['FSC', 'SSC']
+UNANALYZED_TYPES = ['TIM', 'NUL']
+
+
+def get_full_name(param):
+    """
+    Returns the normalized name of a site panel parameter, used to match
+    the parameters of different panels, e.g. 'FL_A_CD3_CD8_FITC':
+    <parameter type>_<value type>[_<sorted markers>][_<fluorochrome>]
+    """
+    param_str = "_".join(
+        [param['parameter_type'], param['parameter_value_type']]
+    )
+
+    markers = sorted(marker['name'] for marker in param['markers'])
+    if len(markers) > 0:
+        param_str = "_".join([param_str, "_".join(markers)])
+
+    if param['fluorochrome']:
+        fluoro = param['fluorochrome']['fluorochrome_abbreviation']
+        param_str = "_".join([param_str, fluoro])
+
+    return param_str
+
+
+class PanelIndex(object):
+    """
+    The channel lookups needed for a site panel, computed once from the
+    panel's parameter annotations when the panel is retrieved, so nothing
+    needs to scan the parameters again. All indices are 0-based FCS
+    channel indices.
+    """
+    def __init__(self, panel):
+        self.channel_count = len(panel['parameters'])
+
+        # full name to the indices of the matching channels (normally
+        # only one), excluding time & null channels
+        self.full_names = dict()
+
+        # negative values in these are filtered out before sub-sampling
+        self.scatter_indices = list()
+
+        # all but the scatter, time, or null channels
+        self.transform_indices = list()
+
+        for param in panel['parameters']:
+            param_type = param['parameter_type']
+            index = param['fcs_number'] - 1
+
+            if param_type in UNANALYZED_TYPES:
+                continue
+
+            self.full_names.setdefault(get_full_name(param), []).append(index)
+
+            if param_type in SCATTER_TYPES:
+                self.scatter_indices.append(index)
+            else:
+                self.transform_indices.append(index)
+
+    def get_indices(self, full_names):
+        """
+        Returns the channel indices for the given full names, in the same
+        order, skipping any names not in the panel
+        """
+        indices = list()
+        for full_name in full_names:
+            indices.extend(self.full_names.get(full_name, []))
+
+        return indices
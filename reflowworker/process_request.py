@@ -1,6 +1,18 @@
-from settings import CACHE_DIR
-from sample_models import Sample
+from settings import CACHE_DIR, SAMPLE_CACHE_DIR, SUBSAMPLE_CACHE_DIR, \
+    TRANSFORMED_CACHE_DIR, COMPONENTS_CACHE_DIR, DEFAULT_SAMPLE_CACHE_SIZE, \
+    DEFAULT_SUBSAMPLE_CACHE_SIZE, DEFAULT_TRANSFORMED_CACHE_SIZE, \
+    DEFAULT_COMPONENTS_CACHE_SIZE, \
+    DEFAULT_DOWNLOAD_CONCURRENCY, DEFAULT_UPLOAD_CONCURRENCY, \
+    DEFAULT_PREPROCESS_CONCURRENCY, DEFAULT_PREPROCESS_FLOAT32, \
+    DEFAULT_PREPROCESS_THREADS
+from sample_models import Sample, LOGICLE_T, LOGICLE_W, ASINH_PRE_SCALE, \
+    EVENT_CHUNK_SIZE
+from sample_cache import SampleCache, SubsampleCache, TransformedCache, \
+    ComponentsCache
+from panel_index import PanelIndex
 from clustering_processes import hdp
+from subsampling import draw_subsample, SUBSAMPLE_MODES, \
+    DEFAULT_SUBSAMPLE_MODE
 
 # NOTE: We import logger here for logging info and for more granular
 #       errors useful for troubleshooting. All exceptions should be caught
@@ -8,12 +20,30 @@ from clustering_processes import hdp
 from logger import logger
 from processing_error import ProcessingError
 
-import re
+import cPickle
+import hashlib
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
 import shutil
+import threading
 import time
 import numpy as np
 from reflowrestclient import utils
 
+# The ProcessRequest being pre-processed by a pool of processes. It's set
+# before the pool is created, so the forked pool processes inherit it and
+# only sample indices & results need to be passed between processes.
+_pool_process_request = None
+
+
+def _pre_process_pool_sample(sample_index):
+    process_request = _pool_process_request
+    return process_request._pre_process_sample(
+        process_request.samples[sample_index]
+    )
+
 
 class ProcessRequest(object):
     """
@@ -28,12 +58,18 @@ class ProcessRequest(object):
           ProcessingError is re-raised so the WorkerProcess can report them
           back to the ReFlow server.
     """
-    def __init__(self, host, token, pr_dict, method):
+    def __init__(self, host, token, pr_dict, method, options=None):
         self.host = host
         self.token = token
         self.method = method  # 'http://' or 'https://'
         self.process_request_id = pr_dict['id']
 
+        # processing options from the worker config, see settings for the
+        # defaults of any missing options
+        if options is None:
+            options = dict()
+        self.options = options
+
         # for tracking & reporting back progress
         self.percent_complete = 0
 
@@ -43,14 +79,19 @@ class ProcessRequest(object):
         self.parent_clusters = []
         for c in pr_dict['stage2_clusters']:
             self.parent_clusters.append(c['cluster'])
+        # parsed parent stage components of each sample, keyed by sample PK
+        self.parent_components = dict()
 
         self.random_seed = None
+        # version of the sub-sampling algorithm, kept with the PR's state
+        # so re-running the PR chooses exactly the same events
+        self.subsample_mode = None
         self.sample_collection_id = pr_dict['sample_collection']
         self.subsample_count = pr_dict['subsample_count']
-        self.directory = "%s%s/process_requests/%s" % (
-            CACHE_DIR,
+        self.directory = self.get_directory(
             self.host,
-            self.process_request_id)
+            self.process_request_id
+        )
         self.inputs = pr_dict['inputs']
         self.samples = list()
         self.panels = dict()
@@ -69,6 +110,10 @@ class ProcessRequest(object):
         # keys will be site panel PK, and values will be a list of indices...
         self.panel_maps = dict()
 
+        # panel_indices holds a PanelIndex of each site panel's channels,
+        # built as the panel is retrieved. Keys are site panel PKs
+        self.panel_indices = dict()
+
         # lookup the sample collection
         response = utils.get_sample_collection(
             self.host,
@@ -84,14 +129,32 @@ class ProcessRequest(object):
         )
 
         # populate self.samples w/Sample instances w/compensation
+        # Members often share the same compensation, so each distinct
+        # compensation is only parsed & inverted once, keyed by its string
+        compensations = dict()
         for member in response['data']['members']:
+            if member['compensation'] not in compensations:
+                try:
+                    compensation = self._convert_matrix(
+                        member['compensation']
+                    )
+                    compensations[member['compensation']] = (
+                        compensation,
+                        np.linalg.inv(compensation[1:, :])
+                    )
+                except Exception as e:
+                    logger.error(str(e), exc_info=True)
+                    raise ProcessingError("Error parsing compensation")
+
+            compensation, compensation_inverse = \
+                compensations[member['compensation']]
             try:
-                compensation = self._convert_matrix(member['compensation'])
-            except Exception as e:
-                logger.error(str(e), exc_info=True)
-                raise ProcessingError("Error parsing compensation")
-            try:
-                sample = Sample(self, member['sample'], compensation)
+                sample = Sample(
+                    self,
+                    member['sample'],
+                    compensation,
+                    compensation_inverse
+                )
             except Exception as e:
                 logger.error(str(e), exc_info=True)
                 raise ProcessingError("Error retrieving samples")
@@ -109,12 +172,88 @@ class ProcessRequest(object):
                     logger.error(str(e), exc_info=True)
                     raise ProcessingError("Error retrieving sample annotation")
                 self.panels[sample.site_panel_id] = panel_response['data']
+                self.panel_indices[sample.site_panel_id] = PanelIndex(
+                    panel_response['data']
+                )
 
         logger.info(
             "(PR: %s) Sample instances created",
             str(self.process_request_id)
         )
 
+    @staticmethod
+    def get_directory(host, process_request_id):
+        """
+        Returns the working directory for a PR's intermediate files
+        """
+        return "%s%s/process_requests/%s" % (
+            CACHE_DIR,
+            host,
+            process_request_id
+        )
+
+    @staticmethod
+    def load_state(host, process_request_id, token):
+        """
+        Returns the ProcessRequest instance saved by save_state(), with
+        the given token, which isn't saved
+
+        Raises ValueError if the state file or its directory could have
+        been replaced by another user, unpickling it could run their code
+        """
+        directory = ProcessRequest.get_directory(host, process_request_id)
+        state_path = directory + '/state.pkl'
+
+        for path in [directory, state_path]:
+            st = os.stat(path)
+            if st.st_uid != os.getuid() or st.st_mode & 0077:
+                raise ValueError("Unsafe permissions on %s" % path)
+
+        state_file = open(state_path, 'rb')
+        try:
+            process_request = cPickle.load(state_file)
+        finally:
+            state_file.close()
+
+        process_request.token = token
+
+        return process_request
+
+    def save_state(self):
+        """
+        Saves this ProcessRequest (inputs, samples, & any clusters) to the
+        PR working directory, so the next processing stage can pick up
+        where this one left off, even from another process. The directory
+        & file are only accessible by the worker's user (the daemon runs
+        w/ a umask of 0).
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, 0700)
+        os.chmod(self.directory, 0700)
+
+        # write to a new temp file & rename, so the mode is always 0600
+        state_path = self.directory + '/state.pkl'
+        temp_path = "%s.%d" % (state_path, os.getpid())
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        state_file = os.fdopen(
+            os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600),
+            'wb'
+        )
+        try:
+            cPickle.dump(self, state_file, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            state_file.close()
+
+        os.rename(temp_path, state_path)
+
+    def __getstate__(self):
+        # don't save the worker's token with the state
+        state = self.__dict__.copy()
+        state.pop('token', None)
+
+        return state
+
     @staticmethod
     def _convert_matrix(compensation_string):
         """
@@ -123,20 +262,13 @@ class ProcessRequest(object):
         constructor needs
         """
         lines = compensation_string.splitlines(False)
-        headers = re.split(',', lines[0])
-        headers = [int(h) for h in headers]
-
-        # create numpy array and add headers
-        np_array = np.array(headers)
-
-        # now add the matrix data
-        for line in lines[1:]:
-            line_values = re.split(',', line)
-            for i, value in enumerate(line_values):
-                line_values[i] = float(line_values[i])
-            np_array = np.vstack([np_array, line_values])
+        if len(lines) == 1:
+            # just the headers, there's nothing to compensate with
+            raise ValueError("Compensation matrix has no values")
 
-        return np_array
+        # the 1st row holds the channel number headers, followed by the
+        # matrix data, all parsed in one go
+        return np.array([l.split(',') for l in lines], dtype=np.float64)
 
     def _parse_input_parameters(self):
         # iterate through the inputs to validate:
@@ -171,221 +303,717 @@ class ProcessRequest(object):
 
         self.random_seed = int(self.clustering_options['random_seed'])
 
+        # PRs without a sub-sampling mode use the original algorithm
+        self.subsample_mode = self.clustering_options.get(
+            'subsample_mode',
+            DEFAULT_SUBSAMPLE_MODE
+        )
+        if self.subsample_mode not in SUBSAMPLE_MODES:
+            raise ValueError(
+                "Unsupported sub-sampling mode: %s" % self.subsample_mode
+            )
+
         if not self.transformation:
             self.transformation = 'asinh'  # default transform is asinh
 
         # Finally, we need to generate the panel maps used for "normalizing"
         # the samples
-        request_params = []
+        request_params = set()
         for pr_input in self.inputs:
             if pr_input['category_name'] == 'filtering':
                 if pr_input['implementation_name'] == 'parameters':
                     if pr_input['input_name'] == 'parameter':
-                        request_params.append(pr_input['value'])
+                        request_params.add(pr_input['value'])
 
-        # get distinct list of parameters common to all panels in this PR
+        # get distinct list of parameters common to all panels in this PR,
+        # limited to the requested params filter
         param_set = set()
         for panel in self.panels:
-            for param in self.panels[panel]['parameters']:
-                param_type = param['parameter_type']
+            full_names = self.panel_indices[panel].full_names
+            param_set.update(request_params.intersection(full_names))
 
-                if param_type in ['TIM', 'NUL']:
-                    continue
+        # the param_list will be the normalized order of parameters
+        self.param_list = list(param_set)
+        self.param_list.sort()
 
-                value_type = param['parameter_value_type']
+        # panel_maps will hold the re-ordering of each site panel parameter
+        # keys will be site panel PK, and values will be a list of indices...
+        self.panel_maps = dict()
 
-                param_str = "_".join([param_type, value_type])
+        for panel in self.panels:
+            self.panel_maps[panel] = self.panel_indices[panel].get_indices(
+                self.param_list
+            )
 
-                markers = list()
-                for marker in param['markers']:
-                    markers.append(marker['name'])
+    def _get_event_dtype(self):
+        """
+        Returns the dtype used for pre-processed events
+        """
+        if self.options.get('preprocess_float32', DEFAULT_PREPROCESS_FLOAT32):
+            return np.float32
 
-                if len(markers) > 0:
-                    markers.sort()
-                    markers = "_".join(markers)
-                    param_str = "_".join([param_str, markers])
+        return np.float64
 
-                if param['fluorochrome']:
-                    fluoro = param['fluorochrome']['fluorochrome_abbreviation']
-                    param_str = "_".join([param_str, fluoro])
+    def _get_sample_cache(self):
+        return SampleCache(
+            SAMPLE_CACHE_DIR,
+            self.options.get('sample_cache_size', DEFAULT_SAMPLE_CACHE_SIZE)
+        )
 
-                # limit the set to the requested params filter
-                if param_str in request_params:
-                    param_set.add(param_str)
+    def _get_cache_owner(self):
+        """
+        Returns the key used to pin this PR's files in the sample cache
+        """
+        return "%s/%s" % (self.host, str(self.process_request_id))
 
-                param['full_name'] = param_str
+    def _get_subsample_cache(self):
+        """
+        Returns the SubsampleCache, or None if it's disabled
+        """
+        max_size = self.options.get(
+            'subsample_cache_size',
+            DEFAULT_SUBSAMPLE_CACHE_SIZE
+        )
+        if max_size <= 0:
+            return None
 
-        # the param_list will be the normalized order of parameters
-        self.param_list = list(param_set)
-        self.param_list.sort()
+        return SubsampleCache(SUBSAMPLE_CACHE_DIR, max_size)
 
-        # panel_maps will hold the re-ordering of each site panel parameter
-        # keys will be site panel PK, and values will be a list of indices...
-        self.panel_maps = dict()
+    def _get_transform_params(self):
+        """
+        Returns the parameters used for the PR's transformation
+        """
+        if self.transformation == 'logicle':
+            return [LOGICLE_T, LOGICLE_W]
+        elif self.transformation == 'asinh':
+            return [ASINH_PRE_SCALE]
 
-        for panel in self.panels:
-            self.panel_maps[panel] = list()
-            # first, iterate through the param_list so the order is correct
-            for p in self.param_list:
-                for param in self.panels[panel]['parameters']:
-                    if 'full_name' in param:
-                        if param['full_name'] == p:
-                            self.panel_maps[panel].append(
-                                param['fcs_number'] - 1
-                            )
-
-    def _download_samples(self):
-        download_dir = CACHE_DIR + str(self.host) + '/samples/'
-        for s in self.samples:
-            s.download_fcs(self.token, download_dir)
+        return []
 
-    def _pre_process_stage1(self):
-        # we've got a simple 1st stage PR
+    def _get_transformed_cache(self):
+        """
+        Returns the TransformedCache, or None if it's disabled
+        """
+        max_size = self.options.get(
+            'transformed_cache_size',
+            DEFAULT_TRANSFORMED_CACHE_SIZE
+        )
+        if max_size <= 0:
+            return None
+
+        return TransformedCache(TRANSFORMED_CACHE_DIR, max_size)
+
+    def _get_components_cache(self):
+        """
+        Returns the ComponentsCache, or None if it's disabled
+        """
+        max_size = self.options.get(
+            'components_cache_size',
+            DEFAULT_COMPONENTS_CACHE_SIZE
+        )
+        if max_size <= 0:
+            return None
+
+        return ComponentsCache(COMPONENTS_CACHE_DIR, max_size)
+
+    def _get_components_key(self, s):
+        """
+        Returns the ComponentsCache key for a sample's parent stage
+        components
+        """
+        key_parts = [self.host, self.parent_stage, s.sample_id]
+
+        return hashlib.sha1(json.dumps(key_parts)).hexdigest()
+
+    def _get_transform_key_parts(self, s):
+        """
+        Returns a list of everything determining a sample's compensated &
+        transformed events
+        """
+        comp_hash = hashlib.sha1(
+            np.ascontiguousarray(s.compensation, dtype=np.float64).tostring()
+        ).hexdigest()
+
+        return [
+            s.sha1,
+            comp_hash,
+            self.transformation,
+            self._get_transform_params(),
+            self.panel_indices[s.site_panel_id].transform_indices,
+            np.dtype(self._get_event_dtype()).str
+        ]
+
+    def _get_transformed_key(self, s):
+        """
+        Returns the TransformedCache key for a sample
+        """
+        key_parts = self._get_transform_key_parts(s)
+
+        return hashlib.sha1(json.dumps(key_parts)).hexdigest()
+
+    def _get_subsample_key(self, s):
+        """
+        Returns the SubsampleCache key for a 1st stage sample, a SHA-1 of
+        everything determining the sample's pre-processed sub-sample
+        """
+        # the negative scatter filter determines the sub-sampled events
+        key_parts = self._get_transform_key_parts(s) + [
+            self.panel_indices[s.site_panel_id].scatter_indices,
+            self.random_seed,
+            self.subsample_count,
+            self.subsample_mode
+        ]
+
+        return hashlib.sha1(json.dumps(key_parts)).hexdigest()
+
+    def _load_cached_subsamples(self):
+        """
+        Loads the pre-processed sub-samples cached by earlier 1st stage PRs
+        with the same settings. Returns the list of samples that weren't
+        cached, which still need to be downloaded and pre-processed.
+        """
+        subsample_cache = self._get_subsample_cache()
+        if subsample_cache is None or self.parent_stage is not None:
+            return list(self.samples)
+
+        uncached_samples = list()
         for s in self.samples:
-            # Sub-sample events
-            subsample = s.generate_subsample(
-                self.subsample_count,
-                self.random_seed
+            key = self._get_subsample_key(s)
+            try:
+                cached = subsample_cache.get(key, self._get_cache_owner())
+            except Exception as e:
+                # a bad cache entry only costs the time to re-create it
+                logger.warning(str(e), exc_info=True)
+                subsample_cache.remove(key)
+                cached = None
+
+            if cached is None:
+                uncached_samples.append(s)
+                continue
+
+            xform, s.subsample_indices = cached
+            self._save_pre_processed(s, xform)
+
+        if len(uncached_samples) < len(self.samples):
+            logger.info(
+                "(PR: %s) Using %d cached pre-processed samples",
+                str(self.process_request_id),
+                len(self.samples) - len(uncached_samples)
+            )
+
+        return uncached_samples
+
+    def _load_transformed_events(self, s):
+        """
+        Returns a read-only memmap of the sample's compensated & transformed
+        events from the TransformedCache, or None if they're not cached
+        """
+        transformed_cache = self._get_transformed_cache()
+        if transformed_cache is None:
+            return None
+
+        key = self._get_transformed_key(s)
+        try:
+            return transformed_cache.load(key, self._get_cache_owner())
+        except Exception as e:
+            # a bad cache entry only costs the time to re-create it
+            logger.warning(str(e), exc_info=True)
+            transformed_cache.remove(key)
+            return None
+
+    def _create_transformed_events(self, s, shape):
+        """
+        Returns a writable memmap for the sample's compensated & transformed
+        events, to be saved in the TransformedCache by
+        _save_transformed_events(), or None if the cache is disabled
+        """
+        transformed_cache = self._get_transformed_cache()
+        if transformed_cache is None:
+            return None
+
+        try:
+            return transformed_cache.create(
+                self._get_transformed_key(s),
+                shape,
+                self._get_event_dtype()
+            )
+        except Exception as e:
+            # not fatal, the events just won't be re-used
+            logger.warning(str(e), exc_info=True)
+            return None
+
+    def _save_transformed_events(self, s, transformed_events):
+        try:
+            transformed_events.flush()
+            transformed_cache = self._get_transformed_cache()
+            key = self._get_transformed_key(s)
+            transformed_cache.add(
+                key,
+                transformed_events.filename,
+                self._get_cache_owner()
             )
+            transformed_cache.release(key, self._get_cache_owner())
+        except Exception as e:
+            # not fatal, the events just won't be re-used
+            logger.warning(str(e), exc_info=True)
 
-            # Compensate the sub-sampled events
-            comped_sub = s.compensate_events(subsample)
+    def _keep_transformed_events(self, s):
+        """
+        Pre-processes all of a 1st stage sample's events into the
+        TransformedCache for later 2nd stage PRs, if the cache is enabled
+        and they're not already cached
+        """
+        if self._get_transformed_cache() is None:
+            return
+        if self._load_transformed_events(s) is not None:
+            return
+
+        events = s.get_event_view()
+        transformed_events = self._create_transformed_events(
+            s,
+            events.shape
+        )
+        if transformed_events is None:
+            return
 
-            # Apply specified transform to compensated events
-            if self.transformation == 'logicle':
-                xform = s.apply_logicle_transform(comped_sub)
-            elif self.transformation == 'asinh':
-                xform = s.apply_asinh_transform(comped_sub)
+        s.pre_process_events(
+            events,
+            self.transformation,
+            out=transformed_events
+        )
+        self._save_transformed_events(s, transformed_events)
 
-            # save xform as pre-processed data
-            s.create_preprocessed(xform, self.directory + '/preprocessed')
+    def _save_cached_subsample(self, s, xform):
+        subsample_cache = self._get_subsample_cache()
+        if subsample_cache is None:
+            return
 
-            # next is normalization of common sample parameters
-            s.create_normalized(
+        try:
+            subsample_cache.put(
+                self._get_subsample_key(s),
                 xform,
-                self.directory + '/normalized',
-                self.panel_maps[s.site_panel_id]
+                s.subsample_indices,
+                self._get_cache_owner()
             )
+        except Exception as e:
+            # not fatal, the sub-sample just won't be re-used
+            logger.warning(str(e), exc_info=True)
 
-    def _pre_process_stage2(self):
-        # we've got a 2nd stage PR, so much more pre-processing to do...
-        # Only a few of the 1st stage clusters were selected for analysis,
-        # so we use the original stage 1 model to classify all events to
-        # enrich a new sub-sample with events from those selected clusters
-        for s in self.samples:
-            # get all events
-            data = s.get_all_events()
+    def _download_samples(self, samples):
+        """
+        Downloads & validates the given samples, up to
+        'download_concurrency' at a time. Each sample gets 3 attempts, if
+        any sample fails the remaining downloads are skipped & a
+        ProcessingError is raised.
+        """
+        sample_cache = self._get_sample_cache()
+        owner = self._get_cache_owner()
+
+        cancel = threading.Event()
+        progress_lock = threading.Lock()
+        downloaded = [0]  # list so the count can be updated by download()
+
+        def download(sample):
+            self._call_with_retries(
+                lambda: sample.download_fcs(self.token, sample_cache, owner),
+                "Download of sample %s" % str(sample.sample_id),
+                "Downloading samples failed",
+                cancel
+            )
+            if cancel.is_set():
+                return
+
+            with progress_lock:
+                downloaded[0] += 1
+                logger.info(
+                    "(PR: %s) Sample %s ready (%d of %d)",
+                    str(self.process_request_id),
+                    str(sample.sample_id),
+                    downloaded[0],
+                    len(samples)
+                )
+
+        pool = ThreadPool(
+            self.options.get(
+                'download_concurrency',
+                DEFAULT_DOWNLOAD_CONCURRENCY
+            )
+        )
+
+        try:
+            pool.map(download, samples)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _release_samples(self):
+        """
+        Releases this PR's pins on the cached sample files, they're only
+        needed until pre-processing is done
+        """
+        try:
+            sample_cache = self._get_sample_cache()
+            for s in self.samples:
+                sample_cache.release(s.sha1, self._get_cache_owner())
+        except Exception as e:
+            # not fatal, the pins will be dropped when this process exits
+            logger.warning(str(e), exc_info=True)
+
+    @staticmethod
+    def _parse_parent_components(components):
+        """
+        Parses a sample's components from the ReFlow 'data' list into the
+        parent cluster, weight, locations, and covariance matrix of each
+        component, along with the channel indices of the locations &
+        covariance matrices.
+        """
+        parsed = {
+            'clusters': [],
+            'weights': [],
+            'locations': [],
+            'covariances': [],
+            'indices': []
+        }
+
+        for comp in components:
+            # The 1st line of the covariance matrix has the channel indices.
+            # Use the channel order from the covariance matrix to avoid
+            # re-arranging the covariance matrix.
+            matrix = np.array(
+                [l.split(',') for l in comp['covariance_matrix'].splitlines()],
+                dtype=np.float64
+            )
+            indices = [int(i) for i in matrix[0]]
+
+            location_map = dict()
+            for c in comp['parameters']:
+                location_map[c['channel'] - 1] = c['location']
 
-            # compensate all events
-            data = s.compensate_events(data)
+            parsed['clusters'].append(int(comp['cluster']))
+            parsed['weights'].append(comp['weight'])
+            parsed['locations'].append(
+                [location_map[i] for i in indices if i in location_map]
+            )
+            parsed['covariances'].append(matrix[1:])
+            parsed['indices'] = indices
+
+        return parsed
+
+    def _load_parent_components(self, samples):
+        """
+        Retrieves & parses the parent stage components of the given
+        samples, up to 'download_concurrency' samples at a time. Parsed
+        components are saved for later 2nd stage PRs of the same parent
+        stage, which skip retrieving & parsing them.
+        """
+        components_cache = self._get_components_cache()
+        owner = self._get_cache_owner()
+        cancel = threading.Event()
+
+        def load(sample):
+            key = self._get_components_key(sample)
+
+            if components_cache is not None:
+                try:
+                    components = components_cache.get(key, owner)
+                except Exception as e:
+                    # a bad file only costs retrieving the components again
+                    logger.warning(str(e), exc_info=True)
+                    components_cache.remove(key)
+                    components = None
 
-            # transform all events
-            if self.transformation == 'logicle':
-                data = s.apply_logicle_transform(data)
-            elif self.transformation == 'asinh':
-                data = s.apply_asinh_transform(data)
+                if components is not None:
+                    self.parent_components[sample.sample_id] = components
+                    return
 
-            # Retrieve this sample's components from parent stage
-            # NOTE: Each user-selected cluster can contain multiple components
             response = utils.get_sample_cluster_components(
                 self.host,
                 self.token,
                 process_request_pk=self.parent_stage,
-                sample_pk=s.sample_id,
+                sample_pk=sample.sample_id,
                 method=self.method
             )
+            components = self._parse_parent_components(response['data'])
 
-            components = response['data']
-
-            # create the DPCluster instances & save a map of the
-            # components that belong to the specified clusters from stage 1
-            # NOTE: Import from flowstats here to avoid a PyCUDA issue when
-            #       starting up the daemonize procedure
-            from flowstats.dp_cluster import DPCluster, DPMixture
-            dp_clusters = []
-            enrich_components = []
-            indices = []
-            for comp_idx, comp in enumerate(components):
-                # determine if this comp was a member of a user-specified
-                # cluster to include for analysis
-                if int(comp['cluster']) in self.parent_clusters:
-                    enrich_components.append(comp_idx)
-
-                # use the channel order from the covariance matrix to
-                # avoid re-arranging the covariance matrix
-                # all the covariance matrices in all components will have
-                # been saved in the same order from the 1st stage
-                covariance = []
-                for l in comp['covariance_matrix'].splitlines():
-                    covariance.append(
-                        [float(n) for n in l.split(',')]
-                    )
-                indices = covariance.pop(0)
-                indices = [int(i) for i in indices]
-                covariance = np.array(covariance)
-
-                locations = []
-                for i in indices:
-                    for c in comp['parameters']:
-                        if (c['channel'] - 1) == i:
-                            locations.append(c['location'])
-
-                dp_clusters.append(
-                    DPCluster(
-                        comp['weight'],
-                        locations,
-                        covariance
-                    )
+            if components_cache is not None:
+                try:
+                    components_cache.put(key, components, owner)
+                except Exception as e:
+                    # not fatal, the components just won't be re-used
+                    logger.warning(str(e), exc_info=True)
+
+            self.parent_components[sample.sample_id] = components
+
+        def load_with_retries(sample):
+            self._call_with_retries(
+                lambda: load(sample),
+                "Retrieval of sample %s components" % str(sample.sample_id),
+                "Retrieving parent stage components failed",
+                cancel
+            )
+
+        pool = ThreadPool(
+            self.options.get(
+                'download_concurrency',
+                DEFAULT_DOWNLOAD_CONCURRENCY
+            )
+        )
+
+        try:
+            pool.map(load_with_retries, samples)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _pre_process_stage1(self, s):
+        # we've got a simple 1st stage PR
+        # Sub-sample events
+        subsample = s.generate_subsample(
+            self.subsample_count,
+            self.random_seed,
+            self.subsample_mode
+        )
+
+        # Compensate the sub-sampled events & apply specified transform
+        xform = s.pre_process_events(
+            subsample,
+            self.transformation,
+            self._get_event_dtype()
+        )
+
+        self._save_pre_processed(s, xform)
+        self._save_cached_subsample(s, xform)
+
+        # optionally keep all the events pre-processed for 2nd stage PRs
+        self._keep_transformed_events(s)
+
+    def _save_pre_processed(self, s, xform):
+        # save xform as pre-processed data
+        s.create_preprocessed(xform, self.directory + '/preprocessed')
+
+        # next is normalization of common sample parameters
+        s.create_normalized(
+            xform,
+            self.directory + '/normalized',
+            self.panel_maps[s.site_panel_id]
+        )
+
+    def _pre_process_stage2(self, s):
+        # we've got a 2nd stage PR, so much more pre-processing to do...
+        # Only a few of the 1st stage clusters were selected for analysis,
+        # so we use the original stage 1 model to classify all events to
+        # enrich a new sub-sample with events from those selected clusters
+
+        # This sample's components from the parent stage were retrieved &
+        # parsed beforehand, see _load_parent_components()
+        # NOTE: Each user-selected cluster can contain multiple components
+        components = self.parent_components[s.sample_id]
+
+        # save a map of the components that belong to the specified
+        # clusters from stage 1
+        enrich_components = []
+        for comp_idx, cluster in enumerate(components['clusters']):
+            # determine if this comp was a member of a user-specified
+            # cluster to include for analysis
+            if cluster in self.parent_clusters:
+                enrich_components.append(comp_idx)
+
+        # all the covariance matrices in all components have the same
+        # channel order from the 1st stage
+        indices = components['indices']
+
+        # create the DPCluster instances
+        # NOTE: Import from flowstats here to avoid a PyCUDA issue when
+        #       starting up the daemonize procedure
+        from flowstats.dp_cluster import DPCluster, DPMixture
+        dp_clusters = []
+        for weight, locations, covariance in zip(
+                components['weights'],
+                components['locations'],
+                components['covariances']):
+            dp_clusters.append(DPCluster(weight, locations, covariance))
+
+        dp_mixture = DPMixture(dp_clusters)
+
+        # Compensate, transform, & classify the events in chunks, reading
+        # them straight from the (memory-mapped) FCS data, and keep only
+        # the indices of events in the enriched components. Each event is
+        # classified on its own, so the result is the same as classifying
+        # all events at once. The compensated events differ from the
+        # original flowutils compensation by a few ULPs (see
+        # Sample.compensate_events), which only changes the classification
+        # of an event within ~1e-12 of a component boundary.
+        # If an earlier PR kept this sample's transformed events they're
+        # read directly instead. Otherwise, if the TransformedCache is
+        # enabled, the transformed chunks are saved for later PRs.
+        event_dtype = self._get_event_dtype()
+        transformed_events = self._load_transformed_events(s)
+        new_transformed_events = None
+        if transformed_events is not None:
+            events = transformed_events
+        else:
+            events = s.get_event_view()
+            new_transformed_events = self._create_transformed_events(
+                s,
+                events.shape
+            )
+
+        # rank of each enriched component in enrich_components, used to
+        # order the enriched events by component
+        component_ranks = np.zeros(len(components['clusters']), np.int64)
+        component_ranks[enrich_components] = np.arange(len(enrich_components))
+
+        def classify_chunk(start):
+            if transformed_events is not None:
+                data = transformed_events[start:start + EVENT_CHUNK_SIZE]
+            else:
+                data = s.pre_process_events(
+                    events[start:start + EVENT_CHUNK_SIZE],
+                    self.transformation,
+                    event_dtype
                 )
+                if new_transformed_events is not None:
+                    new_transformed_events[start:start + len(data)] = data
 
-            dp_mixture = DPMixture(dp_clusters)
             classifications = dp_mixture.classify(data[:, indices])
-            enrich_indices = []
-            for ec in enrich_components:
-                # note: where returns a tuple where first item is a
-                # numpy array containing the indices...probably does this
-                # for compatibility with numpy fancy indexing
-                enrich_indices.extend(
-                    np.where(classifications == ec)[0]
-                )
 
-            if len(enrich_indices) < self.subsample_count:
-                actual_subsample_count = len(enrich_indices)
-            else:
-                actual_subsample_count = self.subsample_count
-
-            # shuffle the enriched indices and draw our subsample
-            # saving the chosen indices for the sample
-            # Note: we create a new RandomState per file to guarantee
-            # reproducible sampling for each file between PRs. The same
-            # file may be analyzed with any number of other files, so could
-            # occur in a different order. This makes sure we get the same
-            # sub-sample between runs regardless of the order or number of
-            # files.
-            rng = np.random.RandomState()
-            rng.seed(self.random_seed)
-            rng.shuffle(enrich_indices)
-            s.subsample_indices = enrich_indices[:actual_subsample_count]
-
-            # save subsample as pre-processed data
-            s.create_preprocessed(
-                data[s.subsample_indices], self.directory + '/preprocessed'
+            # returns the enriched events' indices and component ranks
+            enriched = np.flatnonzero(
+                np.in1d(classifications, enrich_components)
+            )
+            return (
+                enriched.astype(np.int64) + start,
+                component_ranks[classifications[enriched]]
             )
 
-            # next is normalization of common sample parameters
-            s.create_normalized(
-                data[s.subsample_indices],
-                self.directory + '/normalized',
-                self.panel_maps[s.site_panel_id]
+        pool = ThreadPool(
+            self.options.get('preprocess_threads', DEFAULT_PREPROCESS_THREADS)
+        )
+        try:
+            chunk_results = pool.map(
+                classify_chunk,
+                range(0, len(events), EVENT_CHUNK_SIZE)
             )
+        finally:
+            pool.close()
+            pool.join()
+
+        if new_transformed_events is not None:
+            self._save_transformed_events(s, new_transformed_events)
+
+        # Order the enriched indices by component (in enrich_components
+        # order), then by event. This must stay the same as the order of
+        # the original per-component np.where() results, so the shuffled
+        # sub-sample is identical for a given seed (barring the boundary
+        # events noted above).
+        enrich_indices = np.concatenate(
+            [np.empty(0, np.int64)] + [r[0] for r in chunk_results]
+        )
+        enrich_ranks = np.concatenate(
+            [np.empty(0, np.int64)] + [r[1] for r in chunk_results]
+        )
+        enrich_indices = enrich_indices[
+            np.argsort(enrich_ranks, kind='mergesort')
+        ]
+        del enrich_ranks
 
-    def _pre_process(self):
-        if self.parent_stage is None:
-            self._pre_process_stage1()
+        if len(enrich_indices) < self.subsample_count:
+            actual_subsample_count = len(enrich_indices)
+        else:
+            actual_subsample_count = self.subsample_count
+
+        # shuffle the enriched indices and draw our subsample
+        # saving the chosen indices for the sample
+        # Note: we create a new RandomState per file to guarantee
+        # reproducible sampling for each file between PRs. The same
+        # file may be analyzed with any number of other files, so could
+        # occur in a different order. This makes sure we get the same
+        # sub-sample between runs regardless of the order or number of
+        # files.
+        s.subsample_indices = draw_subsample(
+            enrich_indices,
+            actual_subsample_count,
+            self.random_seed,
+            self.subsample_mode
+        ).copy()  # copied so the full index array can be freed
+
+        chosen_events = events[
+            np.asarray(s.subsample_indices, dtype=np.int64)
+        ]
+        if transformed_events is not None:
+            xform = chosen_events
         else:
-            self._pre_process_stage2()
+            # only the sub-sampled events need to be pre-processed again
+            xform = s.pre_process_events(
+                chosen_events,
+                self.transformation,
+                event_dtype
+            )
+
+        self._save_pre_processed(s, xform)
+
+    def _pre_process_sample(self, s):
+        """
+        Pre-processes a single sample, returning the sample attributes set
+        by pre-processing so they can be passed back from a pool process
+        """
+        try:
+            if self.parent_stage is None:
+                self._pre_process_stage1(s)
+            else:
+                self._pre_process_stage2(s)
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+            raise ProcessingError(
+                "Pre-processing failed for sample %s" % str(s.sample_id)
+            )
+
+        return s.subsample_indices, s.preprocessed_path, s.normalized_path
+
+    def _pre_process(self, samples):
+        """
+        Pre-processes the given samples, up to 'preprocess_concurrency' at a
+        time in separate processes. Each sample is processed independently (the
+        sub-sampling RandomState is seeded per sample), so the results are
+        the same regardless of the number of processes. Must be run from a
+        non-daemonic process, see WorkerProcess._run_prepare().
+        """
+        global _pool_process_request
+
+        concurrency = min(
+            self.options.get(
+                'preprocess_concurrency',
+                DEFAULT_PREPROCESS_CONCURRENCY
+            ),
+            len(samples)
+        )
+
+        if concurrency <= 1:
+            for s in samples:
+                self._pre_process_sample(s)
+            return
 
-    def analyze(self, device):
+        _pool_process_request = self
+        pool = multiprocessing.Pool(concurrency)
+
+        try:
+            results = pool.imap(
+                _pre_process_pool_sample,
+                [self.samples.index(s) for s in samples]
+            )
+            for s, result in zip(samples, results):
+                s.subsample_indices, s.preprocessed_path, \
+                    s.normalized_path = result
+        finally:
+            pool.terminate()
+            pool.join()
+            _pool_process_request = None
+
+    def prepare(self):
+        """
+        Validates the inputs, downloads the samples, and pre-processes the
+        sample data. After this the PR is ready for clustering.
+        """
         # First, validate the inputs, this also populates the panel maps
         # used for "normalizing" the sample data columns
         try:
@@ -395,13 +1023,24 @@ class ProcessRequest(object):
             raise ProcessingError("Invalid process request inputs")
 
         logger.info(
-            "(PR: %s) Input parameters validated",
-            str(self.process_request_id)
+            "(PR: %s) Input parameters validated, sub-sampling mode %s",
+            str(self.process_request_id),
+            self.subsample_mode
         )
 
+        try:
+            self._download_and_pre_process()
+        finally:
+            self._release_samples()
+
+    def _download_and_pre_process(self):
+        # Samples pre-processed by an earlier PR with the same settings
+        # don't need to be downloaded or pre-processed again
+        samples = self._load_cached_subsamples()
+
         # Download the samples
         try:
-            self._download_samples()
+            self._download_samples(samples)
         except Exception as e:
             logger.error(str(e), exc_info=True)
             raise ProcessingError("Downloading samples failed")
@@ -411,11 +1050,20 @@ class ProcessRequest(object):
             str(self.process_request_id)
         )
 
+        if self.parent_stage is not None:
+            try:
+                self._load_parent_components(samples)
+            except Exception as e:
+                logger.error(str(e), exc_info=True)
+                raise ProcessingError(
+                    "Retrieving parent stage components failed"
+                )
+
         # Pre-process data...takes care of various combinations of tasks
         # Afterward, all samples' subsampled data files will be available &
         # ready for analysis
         try:
-            self._pre_process()
+            self._pre_process(samples)
         except ProcessingError as e:
             logger.error(e.message, exc_info=True)
             raise
@@ -428,7 +1076,11 @@ class ProcessRequest(object):
             str(self.process_request_id)
         )
 
-        # next is clustering
+    def cluster(self, device):
+        """
+        Runs the clustering on the given device, the PR must have been
+        prepared first. Results are saved in self.clusters
+        """
         if self.clustering == 'hdp':
             try:
                 self.clusters = hdp(self, device)
@@ -457,12 +1109,54 @@ class ProcessRequest(object):
                 method=self.method
             )
 
+    def _call_with_retries(self, func, description, error_message, cancel):
+        """
+        Calls func() until it succeeds, up to 3 attempts w/ a 2 second
+        delay. Raises a ProcessingError with the given error_message if all
+        attempts fail, setting the cancel event so other concurrent tasks
+        can stop early. Does nothing if cancel has already been set.
+        """
+        max_retries = 3
+        attempt = 0
+
+        while attempt < max_retries:
+            if cancel.is_set():
+                # another task already failed, the PR has failed
+                return
+
+            try:
+                func()
+                return
+            except Exception as e:
+                logger.warning(
+                    "(PR: %s) %s failed - attempt %d of %d",
+                    str(self.process_request_id),
+                    description,
+                    attempt + 1,
+                    max_retries
+                )
+                attempt += 1
+
+                # after 3 strikes, we'll give up
+                if attempt == max_retries:
+                    logger.error(str(e), exc_info=True)
+                    cancel.set()
+                    raise ProcessingError(error_message)
+                else:
+                    # wait a couple seconds before retrying
+                    time.sleep(2.0)
+
     def post_clusters(self):
         """
         POST all clusters and sample clusters (with event classifications)
         to the ReFlow server. This should only be called after local
         processing has finished.
 
+        The Cluster instances are POSTed first to get their ReFlow PKs,
+        then all the SampleCluster instances. Up to 'upload_concurrency'
+        POSTs are made at the same time. If any POST fails the remaining ones
+        are skipped and a ProcessingError is raised, the PR has failed.
+
         Note:
             Every so often the ReFlow server may return a bad response to a
             POST, so we'll employ a 3-strikes and you're out strategy with
@@ -470,73 +1164,57 @@ class ProcessRequest(object):
             the HTTPAdapter but doesn't provide a delay option, so we'll roll
             our own.
         """
-        max_retries = 3
+        cancel = threading.Event()
+
+        def post_cluster(c):
+            self._call_with_retries(
+                lambda: c.post(
+                    self.host,
+                    self.token,
+                    self.method,
+                    self.process_request_id
+                ),
+                "POST for cluster %s" % str(c.index),
+                "Cluster POST failed",
+                cancel
+            )
+
+        def post_sample_cluster(cluster_and_sample_cluster):
+            c, sc = cluster_and_sample_cluster
+            self._call_with_retries(
+                lambda: sc.post(
+                    self.host,
+                    self.token,
+                    self.method,
+                    c.reflow_pk
+                ),
+                "POST for sample cluster (cluster %s)" % str(c.index),
+                "SampleCluster POST failed",
+                cancel
+            )
 
-        # First, post the Cluster instances to get their ReFlow PKs
-        for c in self.clusters:
+        pool = ThreadPool(
+            self.options.get('upload_concurrency', DEFAULT_UPLOAD_CONCURRENCY)
+        )
+
+        try:
+            # First, post the Cluster instances to get their ReFlow PKs
             # POST only if it has no PK
-            if not c.reflow_pk:
-                success = False
-                attempt = 0
-
-                while attempt < max_retries and not success:
-                    try:
-                        c.post(
-                            self.host,
-                            self.token,
-                            self.method,
-                            self.process_request_id
-                        )
-                        success = True
-                    except Exception as e:
-                        logger.warning(
-                            "(PR: %s) POST failed for cluster %s - attempt %d of %d)",
-                            str(self.process_request_id),
-                            str(c.index),
-                            attempt + 1,
-                            max_retries
-                        )
-                        attempt += 1
-
-                        # after 3 strikes, we'll give up
-                        if attempt == max_retries:
-                            logger.error(str(e), exc_info=True)
-                            raise ProcessingError("Cluster POST failed")
-                        else:
-                            # wait a couple seconds before retrying
-                            time.sleep(2.0)
+            pool.map(
+                post_cluster,
+                [c for c in self.clusters if not c.reflow_pk]
+            )
 
             # now save all the sample clusters
-            for sc in c.sample_clusters:
-                success = False
-                attempt = 0
-
-                while attempt < max_retries and not success:
-                    try:
-                        sc.post(
-                            self.host,
-                            self.token,
-                            self.method,
-                            c.reflow_pk
-                        )
-                        success = True
-                    except Exception as e:
-                        logger.warning(
-                            "(PR: %s) POST failed for sample cluster (cluster %s) - attempt %d of %d",
-                            str(self.process_request_id),
-                            str(c.index),
-                            attempt + 1,
-                            max_retries
-                        )
-                        attempt += 1
-
-                        # after 3 strikes, we'll give up
-                        if attempt == max_retries:
-                            logger.error(str(e), exc_info=True)
-                            raise ProcessingError("SampleCluster POST failed")
-                        else:
-                            # wait a couple seconds before retrying
-                            time.sleep(2.0)
+            sample_clusters = list()
+            for c in self.clusters:
+                for sc in c.sample_clusters:
+                    sample_clusters.append((c, sc))
+
+            pool.map(post_sample_cluster, sample_clusters)
+        finally:
+            pool.close()
+            pool.join()
 
         logger.info(
             "(PR: %s) POST of cluster results succeeded",
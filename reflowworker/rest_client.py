@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, \
+    HTTPSConnectionPool
+from reflowrestclient import utils
+
+from stats import stats
+
+# NOTE: reflowrestclient.utils makes every request through the module level
+#       requests functions, so each call opens a new connection (and for
+#       https, a new TLS handshake). install() swaps the requests module
+#       used by utils for a SessionPool, so all the existing utils calls
+#       share keep-alive connections without changing their call sites.
+
+
+def _timed_pool_class(pool_class):
+    """
+    Returns a subclass of the given urllib3 connection pool whose
+    connections record their setup time (TCP connect & TLS handshake)
+    in the process stats as 'http_connection_setup'
+    """
+    class TimedConnection(pool_class.ConnectionCls):
+        def connect(self):
+            start = time.time()
+            super(TimedConnection, self).connect()
+            stats.record('http_connection_setup', time.time() - start)
+
+    return type(
+        'Timed' + pool_class.__name__,
+        (pool_class,),
+        {'ConnectionCls': TimedConnection}
+    )
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connection setup time is recorded in the stats
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _timed_pool_class(HTTPConnectionPool),
+            'https': _timed_pool_class(HTTPSConnectionPool)
+        }
+
+
+class SessionPool(object):
+    """
+    Stand-in for the requests module routing all requests through a
+    keep-alive requests.Session. Sockets must not be shared between
+    processes, so a new Session is created the first time the pool is
+    used in each process (e.g. after the Worker daemonizes or forks a
+    WorkerProcess). Anything else is looked up on the requests module.
+    """
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+
+    def session(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                adapter = TimedHTTPAdapter(
+                    pool_connections=2,
+                    pool_maxsize=self.pool_size
+                )
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+
+                self._session = session
+                self._pid = os.getpid()
+
+            return self._session
+
+    def request(self, method, url, *args, **kwargs):
+        return self.session().request(method, url, *args, **kwargs)
+
+    def get(self, url, *args, **kwargs):
+        return self.session().get(url, *args, **kwargs)
+
+    def options(self, url, *args, **kwargs):
+        return self.session().options(url, *args, **kwargs)
+
+    def head(self, url, *args, **kwargs):
+        return self.session().head(url, *args, **kwargs)
+
+    def post(self, url, *args, **kwargs):
+        return self.session().post(url, *args, **kwargs)
+
+    def put(self, url, *args, **kwargs):
+        return self.session().put(url, *args, **kwargs)
+
+    def patch(self, url, *args, **kwargs):
+        return self.session().patch(url, *args, **kwargs)
+
+    def delete(self, url, *args, **kwargs):
+        return self.session().delete(url, *args, **kwargs)
+
+    def __getattr__(self, name):
+        # exceptions, status codes, etc.
+        return getattr(requests, name)
+
+
+def install(pool_size):
+    """
+    Routes all reflowrestclient.utils requests through a SessionPool.
+    Safe to call more than once.
+    """
+    if not isinstance(utils.requests, SessionPool):
+        utils.requests = SessionPool(pool_size)
@@ -0,0 +1,463 @@
+import errno
+import fcntl
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# NOTE: Don't attempt to log or catch exceptions here, ProcessRequest will
+#       handle any exceptions thrown.
+
+
+def _pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
+
+
+def _load_npz(file_path):
+    """
+    Loads a .npz file w/o allowing pickled (object) arrays, a cache file
+    should never hold one. NumPy before 1.10 has no allow_pickle argument.
+    """
+    try:
+        return np.load(file_path, allow_pickle=False)
+    except TypeError:
+        return np.load(file_path)
+
+
+class SampleCache(object):
+    """
+    Content-addressed cache of downloaded FCS files, keyed by the SHA-1 the
+    ReFlow server provides for each sample. Events decoded from an FCS file
+    may be saved alongside it (see add_events), and are counted in & evicted
+    with the FCS file. The cache is shared by all PRs
+    and all Worker instances on the host, so all changes to the index are
+    made while holding an exclusive lock on the index lock file.
+
+    The index file tracks the size & last use of every cached file, along
+    with the PRs using it, and the (size, mtime, inode) of the file when
+    its SHA-1 was last verified. A PR "pins" the files it uses, and pinned
+    files are never evicted. Pins are stored with the PID of the pinning
+    process, so pins left by a process that died are ignored. When the
+    cache grows beyond max_size bytes, the least recently used files are
+    evicted.
+
+    The cache directories are only accessible by the worker's user, as the
+    cached files are trusted & the daemon runs with a umask of 0.
+    """
+    # extension of the cached files
+    extension = '.fcs'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.index_path = os.path.join(self.directory, 'index.json')
+        self.lock_dir = os.path.join(self.directory, 'locks')
+
+        for d in [self.directory, self.lock_dir]:
+            try:
+                os.makedirs(d, 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # makedirs() doesn't change an existing directory
+            os.chmod(d, 0700)
+
+    def path(self, sha1):
+        return os.path.join(self.directory, sha1 + self.extension)
+
+    def events_path(self, sha1):
+        """
+        Returns the path of the decoded event matrix (.npy) for the SHA-1,
+        which shares the cache lifetime of the FCS file
+        """
+        return os.path.join(self.directory, sha1 + '.npy')
+
+    def temp_dir(self):
+        """
+        Returns a directory for this process to download files into before
+        they're added to the cache, it must be on the same file system for
+        add() to move files into place atomically
+        """
+        temp_dir = os.path.join(self.directory, 'tmp', str(os.getpid())) + '/'
+        if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir, 0700)
+
+        return temp_dir
+
+    @contextmanager
+    def _lock(self, name):
+        lock_file = open(os.path.join(self.lock_dir, name), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    def sample_lock(self, sha1):
+        """
+        Returns a context manager holding an exclusive lock for the given
+        SHA-1, used so only one process downloads a given sample at a time
+        """
+        return self._lock(sha1 + '.lock')
+
+    def _read_index(self):
+        try:
+            index_file = open(self.index_path, 'r')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return dict()
+            raise
+
+        try:
+            return json.load(index_file)
+        except ValueError:
+            # a corrupt index only loses the LRU bookkeeping
+            return dict()
+        finally:
+            index_file.close()
+
+    def _write_index(self, index):
+        temp_path = "%s.%d" % (self.index_path, os.getpid())
+        index_file = open(temp_path, 'w')
+        try:
+            json.dump(index, index_file)
+        finally:
+            index_file.close()
+
+        os.rename(temp_path, self.index_path)
+
+    @contextmanager
+    def _index(self):
+        """
+        Context manager yielding the index dictionary while holding the
+        index lock, any changes are saved on exit
+        """
+        with self._lock('index.lock'):
+            index = self._read_index()
+            yield index
+            self._write_index(index)
+
+    def acquire(self, sha1, owner):
+        """
+        Returns the path of the cached file for the SHA-1, pinned for the
+        given owner, or None if the file isn't cached
+        """
+        with self._index() as index:
+            if sha1 not in index or not os.path.exists(self.path(sha1)):
+                index.pop(sha1, None)
+                return None
+
+            index[sha1]['last_used'] = time.time()
+            index[sha1]['pins'][owner] = os.getpid()
+
+        return self.path(sha1)
+
+    def _file_signature(self, sha1):
+        """
+        Returns the (size, mtime, inode) of the cached file as a list, if
+        any of these change the file must be hashed again
+        """
+        st = os.stat(self.path(sha1))
+
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def is_verified(self, sha1):
+        """
+        Returns True if the cached file was verified against its SHA-1 and
+        hasn't changed since, so there's no need to hash it again
+        """
+        with self._lock('index.lock'):
+            entry = self._read_index().get(sha1)
+
+        if entry is None or 'verified' not in entry:
+            return False
+
+        try:
+            return entry['verified'] == self._file_signature(sha1)
+        except OSError:
+            return False
+
+    def set_verified(self, sha1):
+        """
+        Records that the cached file matches its SHA-1
+        """
+        with self._index() as index:
+            if sha1 in index:
+                index[sha1]['verified'] = self._file_signature(sha1)
+
+    def add(self, sha1, file_path, owner):
+        """
+        Moves the given file, already verified against its SHA-1, into the
+        cache, pinned for the given owner, and evicts other files as needed.
+        Returns the cached file's path.
+        """
+        with self._index() as index:
+            os.rename(file_path, self.path(sha1))
+
+            # any decoded events belonged to the file being replaced
+            self._remove_file(self.events_path(sha1))
+
+            index[sha1] = {
+                'size': os.path.getsize(self.path(sha1)),
+                'last_used': time.time(),
+                'pins': {owner: os.getpid()},
+                'verified': self._file_signature(sha1)
+            }
+
+            self._evict(index)
+
+        return self.path(sha1)
+
+    def add_events(self, sha1, events):
+        """
+        Saves the decoded event matrix of a cached FCS file so later PRs
+        can memory-map it instead of parsing the FCS file again. Does
+        nothing if the FCS file is no longer cached. Returns the path of
+        the saved events, or None.
+        """
+        temp_path = os.path.join(self.temp_dir(), sha1 + '.npy')
+        np.save(temp_path, events)
+
+        with self._index() as index:
+            if sha1 not in index or not os.path.exists(self.path(sha1)):
+                os.remove(temp_path)
+                return None
+
+            os.rename(temp_path, self.events_path(sha1))
+            index[sha1]['size'] = os.path.getsize(self.path(sha1)) + \
+                os.path.getsize(self.events_path(sha1))
+
+            self._evict(index)
+
+        return self.events_path(sha1)
+
+    def release(self, sha1, owner):
+        """
+        Removes the owner's pin on the cached file, allowing its eviction
+        """
+        with self._index() as index:
+            if sha1 in index:
+                index[sha1]['last_used'] = time.time()
+                index[sha1]['pins'].pop(owner, None)
+
+            self._evict(index)
+
+    def remove(self, sha1):
+        """
+        Removes a file from the cache, e.g. if it failed validation
+        """
+        with self._index() as index:
+            index.pop(sha1, None)
+            self._remove_files(sha1)
+
+    @staticmethod
+    def _remove_file(file_path):
+        try:
+            os.remove(file_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _remove_files(self, sha1):
+        self._remove_file(self.path(sha1))
+        self._remove_file(self.events_path(sha1))
+
+    def _is_pinned(self, entry):
+        for owner, pid in entry['pins'].items():
+            if _pid_is_alive(pid):
+                return True
+            # stale pin, the process died
+            del entry['pins'][owner]
+
+        return False
+
+    def _remove_stale_temp_dirs(self):
+        """
+        Removes the temporary directories of processes that have exited,
+        along with any partial files they left behind
+        """
+        temp_root = os.path.join(self.directory, 'tmp')
+        try:
+            pids = os.listdir(temp_root)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+        for pid in pids:
+            if pid.isdigit() and not _pid_is_alive(int(pid)):
+                shutil.rmtree(
+                    os.path.join(temp_root, pid),
+                    ignore_errors=True
+                )
+
+    def _evict(self, index):
+        """
+        Evicts the least recently used, un-pinned files until the cache
+        fits within max_size, and removes temporary files left by exited
+        processes. Must be called holding the index lock.
+        """
+        self._remove_stale_temp_dirs()
+
+        total_size = sum(entry['size'] for entry in index.values())
+        if total_size <= self.max_size:
+            return
+
+        lru = sorted(index, key=lambda s: index[s]['last_used'])
+        for sha1 in lru:
+            if total_size <= self.max_size:
+                break
+            if self._is_pinned(index[sha1]):
+                continue
+
+            total_size -= index[sha1]['size']
+            del index[sha1]
+            self._remove_files(sha1)
+
+
+class SubsampleCache(SampleCache):
+    """
+    Cache of pre-processed sub-samples shared by all PRs on the host, so a
+    PR re-using the samples, compensation, transform, seed, and sub-sample
+    settings of an earlier PR can skip downloading and pre-processing them.
+    Entries are keyed by a SHA-1 of all those settings (see
+    ProcessRequest._get_subsample_key), and each is a .npz file holding
+    the pre-processed 'events' and their original 'indices'. Eviction and
+    locking work the same as for the SampleCache.
+    """
+    extension = '.npz'
+
+    def get(self, key, owner):
+        """
+        Returns the cached (events, indices) for the key, or None if the
+        key isn't cached
+        """
+        file_path = self.acquire(key, owner)
+        if file_path is None:
+            return None
+
+        try:
+            npz_file = _load_npz(file_path)
+            try:
+                return npz_file['events'], npz_file['indices']
+            finally:
+                npz_file.close()
+        finally:
+            self.release(key, owner)
+
+    def put(self, key, events, indices, owner):
+        """
+        Saves the pre-processed events & their indices for the key
+        """
+        temp_path = os.path.join(self.temp_dir(), key + self.extension)
+        np.savez(temp_path, events=events, indices=indices)
+
+        self.add(key, temp_path, owner)
+        self.release(key, owner)
+
+
+class TransformedCache(SampleCache):
+    """
+    Cache of the compensated & transformed events of whole samples, shared
+    by all PRs on the host, so 2nd stage PRs can memory-map them instead of
+    pre-processing every event again. Entries are .npy files keyed by a
+    SHA-1 of the sample, compensation, and transform settings (see
+    ProcessRequest._get_transformed_key). Eviction and locking work the
+    same as for the SampleCache.
+    """
+    extension = '.xform.npy'
+
+    def create(self, key, shape, dtype):
+        """
+        Returns a new, writable .npy memmap in this process's temporary
+        directory. Once written, add it to the cache using add() with the
+        memmap's filename.
+        """
+        return np.lib.format.open_memmap(
+            os.path.join(self.temp_dir(), key + self.extension),
+            mode='w+',
+            dtype=dtype,
+            shape=shape
+        )
+
+    def load(self, key, owner):
+        """
+        Returns a read-only memmap of the cached events for the key, or None
+        if the key isn't cached. The memmap stays valid even if the file is
+        evicted while it's in use.
+        """
+        file_path = self.acquire(key, owner)
+        if file_path is None:
+            return None
+
+        try:
+            return np.load(file_path, mmap_mode='r')
+        finally:
+            self.release(key, owner)
+
+
+class ComponentsCache(SampleCache):
+    """
+    Cache of samples' parsed parent stage components shared by all 2nd
+    stage PRs on the host, so later PRs using the same parent stage skip
+    retrieving & parsing them. Entries are JSON files keyed by a SHA-1 of
+    the host, parent stage, and sample (see
+    ProcessRequest._get_components_key). Eviction and locking work the
+    same as for the SampleCache.
+    """
+    extension = '.json'
+
+    def get(self, key, owner):
+        """
+        Returns the cached components for the key, or None if the key isn't
+        cached
+        """
+        file_path = self.acquire(key, owner)
+        if file_path is None:
+            return None
+
+        try:
+            components_file = open(file_path, 'r')
+            try:
+                components = json.load(components_file)
+            finally:
+                components_file.close()
+        finally:
+            self.release(key, owner)
+
+        # JSON only has lists, restore the covariance matrix arrays
+        components['covariances'] = [
+            np.array(c, dtype=np.float64) for c in components['covariances']
+        ]
+
+        return components
+
+    def put(self, key, components, owner):
+        """
+        Saves the parsed components for the key. Floats are written w/ their
+        repr(), so they're read back exactly.
+        """
+        components = dict(components)
+        components['covariances'] = [
+            c.tolist() for c in components['covariances']
+        ]
+
+        temp_path = os.path.join(self.temp_dir(), key + self.extension)
+        components_file = open(temp_path, 'w')
+        try:
+            json.dump(components, components_file)
+        finally:
+            components_file.close()
+
+        self.add(key, temp_path, owner)
+        self.release(key, owner)
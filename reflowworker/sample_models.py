@@ -7,7 +7,21 @@ import numpy as np
 import flowio
 import flowutils
 
+from fcs_header import FCSHeader
 from processing_error import ProcessingError
+from subsampling import draw_subsample, draw_v2_positions, \
+    DEFAULT_SUBSAMPLE_MODE, SUBSAMPLE_V2
+
+# Read size used when hashing FCS files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Number of events (rows) read at a time when scanning all events
+EVENT_CHUNK_SIZE = 64 * 1024
+
+# Default transform parameters, the logicle defaults match flowutils
+LOGICLE_T = 262144
+LOGICLE_W = 0.5
+ASINH_PRE_SCALE = 0.003
 
 # NOTE: Don't attempt to log or catch exceptions here, ProcessRequest will
 #       handle any exceptions thrown. Exceptions will be raised in cases
@@ -20,10 +34,19 @@ class Sample(object):
     Used by a Worker to manage downloaded samples related to a
     ReFlow ProcessRequest
     """
-    def __init__(self, process_request, sample_dict, compensation):
+    def __init__(
+            self,
+            process_request,
+            sample_dict,
+            compensation,
+            compensation_inverse=None):
         """
         host: the ReFlow host from which the sample originated
         sample_dict: the ReFlow 'data' dictionary
+        compensation: compensation matrix, w/ channel number headers
+        compensation_inverse: inverse of the compensation matrix (w/o
+            headers), computed if not given. Samples sharing a
+            compensation matrix can share its inverse.
 
         Raises KeyError if sample_dict is incomplete
         """
@@ -31,6 +54,9 @@ class Sample(object):
         self.process_request = process_request
         self.sample_id = sample_dict['id']
         self.compensation = compensation
+        if compensation_inverse is None:
+            compensation_inverse = np.linalg.inv(compensation[1:, :])
+        self.compensation_inverse = compensation_inverse
 
         # there are 3 files used for analysis, we store their paths:
         #   fcs_path:
@@ -49,6 +75,8 @@ class Sample(object):
         self.preprocessed_path = None
         self.normalized_path = None
 
+        self.fcs_header = None  # FCSHeader of the downloaded file
+        self.sample_cache = None  # SampleCache holding the FCS file
         self.event_count = None  # total event count
 
         # Save sub-sampled indices for the clustering output
@@ -81,58 +109,105 @@ class Sample(object):
         self.site_panel_id = sample_dict['site_panel']
 
     def _validate_sample_hash(self, file_path):
-        sample_file = open(file_path)
-        sha1_hash = hashlib.sha1(sample_file.read())
-        sample_file.close()
+        # hash the file in chunks, FCS files can be very large
+        sha1_hash = hashlib.sha1()
+        sample_file = open(file_path, 'rb')
+        try:
+            for chunk in iter(lambda: sample_file.read(HASH_CHUNK_SIZE), b''):
+                sha1_hash.update(chunk)
+        finally:
+            sample_file.close()
 
         if sha1_hash.hexdigest() == self.sha1:
             return True
 
         return False
 
-    def download_fcs(self, token, download_dir):
+    def download_fcs(self, token, sample_cache, owner):
         """
-        Updates self.fcs_path with location of downloaded FCS file.
-        ReFlow Worker sample downloads are kept in CACHE_DIR
-        organized by host, then sample id
+        Updates self.fcs_path with location of the FCS file in the shared
+        SampleCache, downloading the file if it isn't cached. The cached
+        file is pinned for the given owner, see SampleCache for details.
         """
-        if not os.path.exists(download_dir):
-            os.makedirs(download_dir)
-        fcs_path = download_dir + str(self.sample_id) + '.fcs'
-
-        # Validate sample's identity via SHA1 hash
-        if os.path.exists(fcs_path):
-            is_valid = self._validate_sample_hash(fcs_path)
-        else:
-            is_valid = False
-
-        if not is_valid:
-            # Either the file wasn't cached or it failed SHA1 validation.
-            # If the file was invalid, try downloading again and re-run
-            # validation check
-            utils.download_sample(
-                self.host,
-                token,
-                sample_pk=self.sample_id,
-                directory=download_dir,
-                method=self.process_request.method
-            )
-
-            if not self._validate_sample_hash(fcs_path):
-                raise ValueError(
-                    "Sample PK %s failed to validate using SHA1"
-                )
+        # only one process should download a given sample at a time
+        with sample_cache.sample_lock(self.sha1):
+            fcs_path = sample_cache.acquire(self.sha1, owner)
+
+            # Validate sample's identity via SHA1 hash, unless the cached
+            # file was already verified and hasn't changed since
+            if fcs_path is not None and \
+                    not sample_cache.is_verified(self.sha1):
+                if self._validate_sample_hash(fcs_path):
+                    sample_cache.set_verified(self.sha1)
+                else:
+                    sample_cache.remove(self.sha1)
+                    fcs_path = None
+
+            if fcs_path is None:
+                # Either the file wasn't cached or it failed SHA1 validation.
+                # Download to a temporary directory, and only add the file
+                # to the cache if it passes validation
+                download_dir = sample_cache.temp_dir()
+                download_path = download_dir + str(self.sample_id) + '.fcs'
+                try:
+                    utils.download_sample(
+                        self.host,
+                        token,
+                        sample_pk=self.sample_id,
+                        directory=download_dir,
+                        method=self.process_request.method
+                    )
+
+                    if not self._validate_sample_hash(download_path):
+                        raise ValueError(
+                            "Sample PK %s failed to validate using SHA1" %
+                            str(self.sample_id)
+                        )
+                except Exception:
+                    # don't leave a partial or invalid download behind
+                    if os.path.exists(download_path):
+                        os.remove(download_path)
+                    raise
+
+                fcs_path = sample_cache.add(self.sha1, download_path, owner)
 
         self.fcs_path = fcs_path
+        self.sample_cache = sample_cache
 
-        # open fcs file to save event count
-        flow_obj = flowio.FlowData(self.fcs_path)
-        self.event_count = flow_obj.event_count
+        # read only the FCS metadata to save event count, the event data
+        # isn't needed until pre-processing
+        self.fcs_header = FCSHeader(self.fcs_path)
+        self.event_count = self.fcs_header.event_count
+
+        # make sure the file matches the site panel annotation
+        panel_index = self.process_request.panel_indices[self.site_panel_id]
+        if panel_index.channel_count != self.fcs_header.channel_count:
+            raise ValueError(
+                "Sample PK %s has %d channels, but its site panel has %d" % (
+                    str(self.sample_id),
+                    self.fcs_header.channel_count,
+                    panel_index.channel_count
+                )
+            )
 
-    def get_all_events(self):
+    def get_event_view(self):
         """
-        Returns NumPy array if all events in FCS file
+        Returns an (events x channels) array of the FCS events, if possible
+        memory-mapped directly from the FCS file's DATA segment so only the
+        rows & columns actually used are read. The values match flowio's,
+        but may be stored in a smaller dtype.
         """
+        if self.fcs_header is None:
+            self.fcs_header = FCSHeader(self.fcs_path)
+
+        events = self.fcs_header.map_events(self.fcs_path)
+        if events is None:
+            # this file's layout can't be mapped, use the decoded events
+            events = self._get_decoded_events()
+
+        return events
+
+    def _parse_events(self):
         # open fcs file & convert events to NumPy array
         flow_obj = flowio.FlowData(self.fcs_path)
         numpy_data = np.reshape(
@@ -142,9 +217,34 @@ class Sample(object):
 
         return numpy_data
 
-    def generate_subsample(self, subsample_count, random_seed):
+    def _get_decoded_events(self):
+        """
+        Returns the events parsed by flowio. The 1st PR to parse a cached
+        FCS file saves the decoded events in the SampleCache, later PRs
+        memory-map the saved events instead of parsing the file again.
+        """
+        if self.sample_cache is None:
+            return self._parse_events()
+
+        # lock so only one process decodes a given sample at a time
+        with self.sample_cache.sample_lock(self.sha1):
+            events_path = self.sample_cache.events_path(self.sha1)
+            if os.path.exists(events_path):
+                return np.load(events_path, mmap_mode='r')
+
+            numpy_data = self._parse_events()
+            self.sample_cache.add_events(self.sha1, numpy_data)
+
+        return numpy_data
+
+    def generate_subsample(
+            self,
+            subsample_count,
+            random_seed,
+            subsample_mode=DEFAULT_SUBSAMPLE_MODE):
         """
-        Sub-samples FCS sample
+        Sub-samples FCS sample, using the given sub-sampling algorithm
+        version (see subsampling.SUBSAMPLE_MODES)
 
         Returns NumPy array if sub-sampling succeeds
         Also updates self.subsample_indices
@@ -153,37 +253,153 @@ class Sample(object):
         # Before sub-sampling we need to filter out events with
         # negative scatter values. To do that we need the parameter
         # annotations
-        params = self.process_request.panels[self.site_panel_id]['parameters']
-        scatter_indices = []
-        for p in params:
-            if p['parameter_type'] in ['FSC', 'SSC']:
-                scatter_indices.append(p['fcs_number'] - 1)
+        panel_index = self.process_request.panel_indices[self.site_panel_id]
+        scatter_indices = panel_index.scatter_indices
+
+        # Only the scatter columns are scanned, in chunks, then only the
+        # sub-sampled rows are read from the (memory-mapped) events, so
+        # the full event matrix is never loaded
+        numpy_data = self.get_event_view()
+
+        if subsample_mode == SUBSAMPLE_V2:
+            self.subsample_indices = self._draw_v2_subsample(
+                numpy_data,
+                scatter_indices,
+                subsample_count,
+                random_seed
+            )
+        else:
+            self.subsample_indices = self._draw_subsample(
+                numpy_data,
+                scatter_indices,
+                subsample_count,
+                random_seed,
+                subsample_mode
+            )
 
-        numpy_data = self.get_all_events()
+        # sub-sample FCS events using given indices
+        subsample = numpy_data[self.subsample_indices]
+        if self.fcs_header.get_data_dtype() is not None:
+            # mapped from the FCS DATA segment, match flowio's dtype
+            subsample = np.asarray(
+                subsample,
+                dtype=self.fcs_header.get_event_dtype()
+            )
 
-        is_neg = numpy_data[:, scatter_indices] < 0
-        is_neg = np.where(is_neg.any(True))[0]
+        return subsample
 
-        if self.event_count - len(is_neg) < subsample_count:
+    @staticmethod
+    def _get_positive_indices(numpy_data, scatter_indices, start):
+        """
+        Returns the indices of the events in the chunk at the given start
+        without any negative scatter values
+        """
+        chunk = numpy_data[start:start + EVENT_CHUNK_SIZE, scatter_indices]
+        return start + np.flatnonzero(~(chunk < 0).any(axis=1))
+
+    @staticmethod
+    def _draw_subsample(
+            numpy_data,
+            scatter_indices,
+            subsample_count,
+            random_seed,
+            subsample_mode):
+        """
+        Returns the sub-sample indices, drawn from the array of all the
+        event indices w/o negative scatter values
+        """
+        is_neg = np.zeros(len(numpy_data), dtype=bool)
+        for start in range(0, len(numpy_data), EVENT_CHUNK_SIZE):
+            chunk = numpy_data[start:start + EVENT_CHUNK_SIZE, scatter_indices]
+            is_neg[start:start + len(chunk)] = (chunk < 0).any(axis=1)
+
+        # NOTE: For the 'v1' mode the shuffled indices must be identical to
+        #       shuffling np.delete(np.arange(event_count), <negative
+        #       scatter indices>) as done previously, so the same seed
+        #       always gives the same sub-sample. flatnonzero gives the same
+        #       int array.
+        positive_indices = np.flatnonzero(~is_neg)
+        del is_neg
+
+        if len(positive_indices) < subsample_count:
             # We used to raise a ProcessingError here, but we'll allow
             # analysis of these samples with fewer events
-            subsample_count = self.event_count - len(is_neg)
+            subsample_count = len(positive_indices)
 
         # generate random indices for subsample
         # using a new RandomState with given seed
-        shuffled_indices = np.arange(self.event_count)
-        shuffled_indices = np.delete(shuffled_indices, is_neg)
-        rng = np.random.RandomState()
-        rng.seed(random_seed)
-        rng.shuffle(shuffled_indices)
+        subsample_indices = draw_subsample(
+            positive_indices,
+            subsample_count,
+            random_seed,
+            subsample_mode
+        )
 
-        # save indices
-        self.subsample_indices = shuffled_indices[:subsample_count]
+        # copied so the full index array can be freed
+        return subsample_indices.copy()
 
-        # sub-sample FCS events using given indices
-        subsample = numpy_data[self.subsample_indices]
+    @classmethod
+    def _draw_v2_subsample(
+            cls,
+            numpy_data,
+            scatter_indices,
+            subsample_count,
+            random_seed):
+        """
+        Returns the 'v2' sub-sample indices, the same as drawing them from
+        the array of all the event indices w/o negative scatter values, but
+        only the number of those events per chunk is kept. The drawn
+        positions are mapped back to events chunk by chunk, so memory
+        scales with the sub-sample & chunk sizes rather than event count.
+        """
+        chunk_starts = range(0, len(numpy_data), EVENT_CHUNK_SIZE)
+        positive_counts = np.array(
+            [
+                len(cls._get_positive_indices(
+                    numpy_data,
+                    scatter_indices,
+                    start
+                )) for start in chunk_starts
+            ],
+            dtype=np.int64
+        )
 
-        return subsample
+        # position of each chunk's first positive event, & the total
+        chunk_offsets = np.concatenate([[0], np.cumsum(positive_counts)])
+        positive_count = chunk_offsets[-1]
+
+        if positive_count < subsample_count:
+            # We used to raise a ProcessingError here, but we'll allow
+            # analysis of these samples with fewer events
+            subsample_count = positive_count
+
+        positions = draw_v2_positions(
+            positive_count,
+            subsample_count,
+            random_seed
+        )
+
+        # the sorted positions in each chunk are a contiguous slice
+        order = np.argsort(positions)
+        sorted_positions = positions[order]
+        bounds = np.searchsorted(sorted_positions, chunk_offsets)
+
+        subsample_indices = np.empty(len(positions), dtype=np.int64)
+        for i, start in enumerate(chunk_starts):
+            first, last = bounds[i], bounds[i + 1]
+            if first == last:
+                continue
+
+            positive_indices = cls._get_positive_indices(
+                numpy_data,
+                scatter_indices,
+                start
+            )
+            subsample_indices[order[first:last]] = positive_indices[
+                sorted_positions[first:last] - chunk_offsets[i]
+            ]
+
+        return subsample_indices
 
     def compensate_events(self, events):
         """
@@ -191,35 +407,36 @@ class Sample(object):
 
         Returns NumPy array of compensated events if successful
         """
-        # self.compensate has headers for the channel numbers, but
-        # flowutils compensate() takes the plain matrix and indices as
-        # separate arguments
+        # self.compensate has headers for the channel numbers
         # (also note channel #'s vs indices)
         indices = self.compensation[0, :] - 1  # headers are channel #'s
         indices = [int(i) for i in indices]
-        comp_matrix = self.compensation[1:, :]  # just the matrix
-        comp_data = flowutils.compensate.compensate(
-            events,
-            comp_matrix,
-            indices
+
+        # Unlike flowutils compensate(), which solves the compensation
+        # matrix for every call, this uses the inverse computed once for
+        # each distinct matrix. The results aren't bit-identical, most
+        # values differ by a few ULPs (~1e-12 relative or less).
+        comp_data = events.copy()
+        comp_data[:, indices] = np.dot(
+            events[:, indices],
+            self.compensation_inverse
         )
 
         return comp_data
 
-    def apply_logicle_transform(self, data, logicle_t, logicle_w):
+    def apply_logicle_transform(
+            self,
+            data,
+            logicle_t=LOGICLE_T,
+            logicle_w=LOGICLE_W):
         """
         Applies logicle transform to given data
 
         Returns NumPy array containing transformed data
         """
         # don't transform scatter, time, or null channels
-        panel = self.process_request.panels[self.site_panel_id]
-        indices = list()
-        for param in panel['parameters']:
-            if param['parameter_type'] in ['FSC', 'SSC', 'TIM', 'NUL']:
-                continue
-            else:
-                indices.append(param['fcs_number'] - 1)
+        panel_index = self.process_request.panel_indices[self.site_panel_id]
+        indices = panel_index.transform_indices
 
         x_data = flowutils.transforms.logicle(
             data,
@@ -230,7 +447,7 @@ class Sample(object):
 
         return x_data
 
-    def apply_asinh_transform(self, data, pre_scale=0.003):
+    def apply_asinh_transform(self, data, pre_scale=ASINH_PRE_SCALE):
         """
         Applies inverse hyperbolic sine transform on given data
 
@@ -240,13 +457,8 @@ class Sample(object):
         Returns NumPy array containing transformed data
         """
         # don't transform scatter, time, or null channels
-        panel = self.process_request.panels[self.site_panel_id]
-        indices = list()
-        for param in panel['parameters']:
-            if param['parameter_type'] in ['FSC', 'SSC', 'TIM', 'NUL']:
-                continue
-            else:
-                indices.append(param['fcs_number'] - 1)
+        panel_index = self.process_request.panel_indices[self.site_panel_id]
+        indices = panel_index.transform_indices
 
         x_data = flowutils.transforms.asinh(
             data,
@@ -256,6 +468,48 @@ class Sample(object):
 
         return x_data
 
+    def pre_process_events(
+            self,
+            events,
+            transformation,
+            dtype=np.float64,
+            out=None):
+        """
+        Compensates & transforms the given events in a single pass over
+        chunks of EVENT_CHUNK_SIZE events, writing into one new array of
+        the given dtype (e.g. np.float32 to halve the memory used), or into
+        the given out array. The events may be memory-mapped (see
+        get_event_view), and are always processed as 64-bit floats.
+
+        The compensation & transforms are applied to each event on its
+        own, so for float64 the result is identical to compensate_events()
+        followed by apply_logicle_transform() or apply_asinh_transform(),
+        without their full size intermediate copies.
+
+        Returns NumPy array of compensated & transformed events
+        """
+        if out is None:
+            x_data = np.empty(events.shape, dtype=dtype)
+        else:
+            x_data = out
+
+        for start in range(0, len(events), EVENT_CHUNK_SIZE):
+            chunk = np.array(
+                events[start:start + EVENT_CHUNK_SIZE],
+                dtype=np.float64
+            )
+
+            chunk = self.compensate_events(chunk)
+
+            if transformation == 'logicle':
+                chunk = self.apply_logicle_transform(chunk)
+            elif transformation == 'asinh':
+                chunk = self.apply_asinh_transform(chunk)
+
+            x_data[start:start + len(chunk)] = chunk
+
+        return x_data
+
     def create_preprocessed(self, data, directory):
         if not os.path.exists(directory):
             os.makedirs(directory)
@@ -322,6 +576,9 @@ class SampleCluster(object):
     A SampleCluster ties a collection of sample events to a particular cluster.
     Each sample can have an independent location for the parent cluster.
     These locations are stored in SampleClusterParameter instances.
+
+    The events are a NumPy array with the event's index in the FCS file as
+    the 1st column, followed by the pre-processed channel values.
     """
     def __init__(
             self,
@@ -336,6 +593,21 @@ class SampleCluster(object):
         self.event_percentage = event_percentage
         self.components = components
 
+    def serialize_events(self):
+        """
+        Returns the events as a list of lists with a header row, ready to
+        be encoded as JSON. The header row is 'event_index' followed by the
+        channel numbers, and the event index is converted back to an int.
+        """
+        header_row = ['event_index']
+        header_row.extend(range(1, self.events.shape[1]))
+
+        event_rows = self.events.tolist()
+        for row in event_rows:
+            row[0] = int(row[0])
+
+        return [header_row] + event_rows
+
     def post(self, host, token, method, cluster_id):
         param_dict = dict()
 
@@ -371,7 +643,7 @@ class SampleCluster(object):
             cluster_id,
             self.sample_id,
             param_dict,
-            self.events,
+            self.serialize_events(),
             self.event_percentage,
             component_list,
             method=method
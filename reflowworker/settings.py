@@ -4,9 +4,82 @@ WORKER_CONF = '/etc/reflow_worker.conf'
 # Time (in seconds) between polling the ReFlow server for available work
 DEFAULT_SLEEP = 15
 
+# Default queue depths for the staged processing pipeline, both can be
+# overridden in the worker configuration file:
+#   prepare_queue_depth:
+#       number of PRs beyond the device count that may be downloaded and
+#       pre-processed ahead of time, waiting for a free device
+#   upload_queue_depth:
+#       number of PRs whose results may be uploaded concurrently
+DEFAULT_PREPARE_QUEUE_DEPTH = 2
+DEFAULT_UPLOAD_QUEUE_DEPTH = 2
+
+# Default number of samples downloaded at the same time for a PR, can be
+# overridden by 'download_concurrency' in the worker configuration file
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+
+# Default number of samples pre-processed at the same time for a PR, each
+# in a separate process, can be overridden by 'preprocess_concurrency' in
+# the worker configuration file
+DEFAULT_PREPROCESS_CONCURRENCY = 4
+
+# Default number of threads used to pre-process & classify chunks of a
+# sample's events in 2nd stage PRs, can be overridden by
+# 'preprocess_threads' in the worker configuration file
+DEFAULT_PREPROCESS_THREADS = 2
+
+# By default pre-processed events are 64-bit floats, set 'preprocess_float32'
+# to true in the worker configuration file to use 32-bit floats, halving the
+# memory used to pre-process all of a sample's events in 2nd stage PRs
+DEFAULT_PREPROCESS_FLOAT32 = False
+
+# Default number of concurrent POSTs when uploading a PR's results, can be
+# overridden by 'upload_concurrency' in the worker configuration file
+DEFAULT_UPLOAD_CONCURRENCY = 8
+
+# By default each device gets a long-lived process which imports flowstats
+# and creates its device context once. Set 'persistent_devices' to false in
+# the worker configuration file to start a new process for every PR.
+DEFAULT_PERSISTENT_DEVICES = True
+
+# Maximum number of keep-alive connections to the ReFlow server kept open
+# by each process, should be at least the upload concurrency
+HTTP_POOL_SIZE = 10
+
+# Time (in seconds) between logging the Worker's own stats
+STATS_INTERVAL = 3600
+
 # Settings for logging messages and errors
 WORKER_LOG = '/var/log/reflow_worker.log'
 LOG_FORMAT = '%(levelname)s: %(asctime)-15s %(name)s: %(message)s'
 
 # Directory to store cached data for processing
 CACHE_DIR = '/var/tmp/ReFlow-data/'
+
+# Directory for the FCS file cache shared by all PRs & Worker instances on
+# this host, and its default size limit in bytes, which can be overridden
+# by 'sample_cache_size' in the worker configuration file
+SAMPLE_CACHE_DIR = CACHE_DIR + 'samples/'
+DEFAULT_SAMPLE_CACHE_SIZE = 50 * 1024 ** 3
+
+# Directory for the cache of pre-processed sub-samples shared by all PRs &
+# Worker instances on this host, and its default size limit in bytes, which
+# can be overridden by 'subsample_cache_size' in the worker configuration
+# file. A size of 0 disables the cache.
+SUBSAMPLE_CACHE_DIR = CACHE_DIR + 'subsamples/'
+DEFAULT_SUBSAMPLE_CACHE_SIZE = 10 * 1024 ** 3
+
+# Directory for the cache of samples' fully compensated & transformed events
+# shared by all PRs & Worker instances on this host, used by 2nd stage PRs
+# to skip pre-processing every event again. Its size limit in bytes can be
+# set by 'transformed_cache_size' in the worker configuration file, by
+# default the cache is disabled as 1st stage PRs then pre-process all events.
+TRANSFORMED_CACHE_DIR = CACHE_DIR + 'transformed/'
+DEFAULT_TRANSFORMED_CACHE_SIZE = 0
+
+# Directory for the cache of parsed parent stage components shared by all
+# 2nd stage PRs & Worker instances on this host, and its default size limit
+# in bytes, which can be overridden by 'components_cache_size' in the worker
+# configuration file. A size of 0 disables the cache.
+COMPONENTS_CACHE_DIR = CACHE_DIR + 'components/'
+DEFAULT_COMPONENTS_CACHE_SIZE = 1024 ** 3
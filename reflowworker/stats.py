@@ -0,0 +1,52 @@
+import threading
+
+from logger import logger
+
+
+class Stats(object):
+    """
+    Simple counters & timers for measuring where a process spends its time.
+    Each process (the Worker and each WorkerProcess) keeps its own Stats,
+    which are logged & reset as each ProcessRequest stage finishes.
+    Safe to use from multiple threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict()
+        self.totals = dict()
+
+    def record(self, name, value=0.0):
+        """
+        Counts one occurrence of name, adding value (e.g. seconds elapsed)
+        to its total
+        """
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.totals[name] = self.totals.get(name, 0.0) + value
+
+    def reset(self):
+        with self._lock:
+            self.counts = dict()
+            self.totals = dict()
+
+    def log(self, prefix):
+        """
+        Logs all the counters, then resets them
+        """
+        with self._lock:
+            counts = self.counts
+            totals = self.totals
+            self.counts = dict()
+            self.totals = dict()
+
+        for name in sorted(counts):
+            logger.info(
+                "%s %s: count %d, total %.3f",
+                prefix,
+                name,
+                counts[name],
+                totals[name]
+            )
+
+
+stats = Stats()
@@ -0,0 +1,80 @@
+import numpy as np
+
+# NOTE: Don't attempt to log or catch exceptions here, ProcessRequest will
+#       handle any exceptions thrown.
+
+# Versions of the sub-sampling algorithm, selected per PR by the
+# 'subsample_mode' clustering input. A given version must always choose
+# the same events for the same seed, so existing algorithms can never
+# change, only new versions may be added.
+#   v1:
+#       shuffle all the candidate events, then take the first N
+#       (the original algorithm, used by PRs without a 'subsample_mode')
+#   v2:
+#       draw N distinct candidate positions by a seeded partial shuffle,
+#       time & memory scale with N rather than the number of candidates
+SUBSAMPLE_V1 = 'v1'
+SUBSAMPLE_V2 = 'v2'
+SUBSAMPLE_MODES = [SUBSAMPLE_V1, SUBSAMPLE_V2]
+DEFAULT_SUBSAMPLE_MODE = SUBSAMPLE_V1
+
+
+def _draw_distinct(rng, population_size, count):
+    """
+    Returns count distinct integers in [0, population_size), in random
+    order, using a partial Fisher-Yates shuffle of the virtual array
+    [0, population_size). Only the swapped positions are stored in a dict,
+    so time & memory scale with count, even when count is close to
+    population_size.
+    """
+    if count >= population_size:
+        return rng.permutation(population_size)
+
+    # position i is swapped with a random position in [i, population_size)
+    positions = np.arange(count)
+    swaps = positions + (
+        rng.random_sample(count) * (population_size - positions)
+    ).astype(np.int64)
+    swaps = np.minimum(swaps, population_size - 1)  # guard float rounding
+
+    swapped = dict()
+    chosen = list()
+    for i, j in enumerate(swaps.tolist()):
+        chosen.append(swapped.get(j, j))
+        # position i is never swapped again, only j's new value is kept
+        swapped[j] = swapped.pop(i, i)
+
+    return np.array(chosen, dtype=np.int64)
+
+
+def draw_v2_positions(candidate_count, count, random_seed):
+    """
+    Returns the positions, in [0, candidate_count), of the candidates the
+    'v2' mode chooses for the given count & seed, so a caller can map them
+    to events without building the full array of candidates
+    """
+    rng = np.random.RandomState()
+    rng.seed(random_seed)
+
+    return _draw_distinct(rng, candidate_count, count)
+
+
+def draw_subsample(candidates, count, random_seed, mode):
+    """
+    Returns up to count of the candidate event indices, chosen at random
+    using a new RandomState with the given seed and the given sub-sampling
+    mode (see SUBSAMPLE_MODES). The chosen indices depend only on the
+    candidates, count, seed, and mode.
+
+    For 'v1' the candidates are shuffled in place.
+    """
+    if mode == SUBSAMPLE_V1:
+        rng = np.random.RandomState()
+        rng.seed(random_seed)
+        rng.shuffle(candidates)
+        return candidates[:count]
+    elif mode == SUBSAMPLE_V2:
+        positions = draw_v2_positions(len(candidates), count, random_seed)
+        return np.asarray(candidates)[positions]
+
+    raise ValueError("Unsupported sub-sampling mode: %s" % mode)
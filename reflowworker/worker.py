@@ -1,16 +1,36 @@
+import errno
+import fcntl
 import json
+import os
+import select
+import signal
 import sys
 import time
-import multiprocessing
 
-import pycuda.driver as cuda
+# PyCUDA is only required for GPU devices, CPU-only hosts can run
+# without it (see the 'cpu_devices' setting)
+try:
+    import pycuda.driver as cuda
+except ImportError:
+    cuda = None
 
 from reflowrestclient import utils
 
-from settings import WORKER_CONF, DEFAULT_SLEEP
+from settings import WORKER_CONF, DEFAULT_SLEEP, \
+    DEFAULT_PREPARE_QUEUE_DEPTH, DEFAULT_UPLOAD_QUEUE_DEPTH, \
+    DEFAULT_PERSISTENT_DEVICES, DEFAULT_UPLOAD_CONCURRENCY, \
+    DEFAULT_SAMPLE_CACHE_SIZE, DEFAULT_DOWNLOAD_CONCURRENCY, HTTP_POOL_SIZE, \
+    STATS_INTERVAL, DEFAULT_PREPROCESS_CONCURRENCY, \
+    DEFAULT_PREPROCESS_FLOAT32, DEFAULT_SUBSAMPLE_CACHE_SIZE, \
+    DEFAULT_PREPROCESS_THREADS, DEFAULT_TRANSFORMED_CACHE_SIZE, \
+    DEFAULT_COMPONENTS_CACHE_SIZE
+from cpu_cluster import CPUDevice
 from daemon import Daemon
 from logger import logger
-from worker_process import WorkerProcess
+from stats import stats
+import rest_client
+from worker_process import WorkerProcess, DeviceProcess, \
+    STAGE_PREPARE, STAGE_CLUSTER, STAGE_UPLOAD
 
 
 class Worker(Daemon):
@@ -25,11 +45,43 @@ class Worker(Daemon):
         self.host = None
         self.name = None
         self.token = None
-        # dictionary of devices where the key is the GPU device ID, and
-        # the value is the ProcessRequest PK if the device is working, or
-        # None if the device is free
+        # dictionary of devices where the key is the GPU device ID (or a
+        # CPUDevice for a group of CPU cores), and the value is the
+        # ProcessRequest PK if the device is working, or None if the
+        # device is free
         self.devices = {}
 
+        # A PR moves through 3 stages, each run in its own WorkerProcess:
+        #   prepare: download & pre-process samples (CPU & I/O bound)
+        #   cluster: run the clustering on a device
+        #   upload: POST the results back to the ReFlow server
+        # Only the cluster stage holds a device, so the other stages for
+        # other PRs can overlap with clustering.
+        # processes holds the running WorkerProcess for each PR PK
+        self.processes = {}
+        # PR PKs that finished pre-processing, waiting for a free device
+        self.ready_queue = []
+        # PR PKs that finished clustering, waiting for an upload slot
+        self.upload_queue = []
+        self.prepare_queue_depth = DEFAULT_PREPARE_QUEUE_DEPTH
+        self.upload_queue_depth = DEFAULT_UPLOAD_QUEUE_DEPTH
+        # options passed on to each ProcessRequest
+        self.options = {
+            'download_concurrency': DEFAULT_DOWNLOAD_CONCURRENCY,
+            'preprocess_concurrency': DEFAULT_PREPROCESS_CONCURRENCY,
+            'preprocess_threads': DEFAULT_PREPROCESS_THREADS,
+            'preprocess_float32': DEFAULT_PREPROCESS_FLOAT32,
+            'upload_concurrency': DEFAULT_UPLOAD_CONCURRENCY,
+            'sample_cache_size': DEFAULT_SAMPLE_CACHE_SIZE,
+            'subsample_cache_size': DEFAULT_SUBSAMPLE_CACHE_SIZE,
+            'transformed_cache_size': DEFAULT_TRANSFORMED_CACHE_SIZE,
+            'components_cache_size': DEFAULT_COMPONENTS_CACHE_SIZE
+        }
+
+        # long-lived DeviceProcess for each device, keyed by device ID
+        self.persistent_devices = DEFAULT_PERSISTENT_DEVICES
+        self.device_processes = {}
+
         # All worker configs are stored in /etc/reflow-worker.conf
         # Exit on any Exception. if we can't open or read the configuration,
         # we cannot continue
@@ -45,15 +97,23 @@ class Worker(Daemon):
             sys.exit("Worker failed to start, see log file for details")
 
         # look for the list of CUDA devices in config file &
-        # test the device numbers as valid CUDA devices
-        # Exit on any Exception. If we do not have any CUDA devices,
+        # test the device numbers as valid CUDA devices. CPU devices
+        # are given as a list of core counts, one per device.
+        # Exit on any Exception. If we do not have any devices,
         # we cannot continue
         # noinspection PyBroadException
         try:
-            cuda.init()
-            for device in worker_json['devices']:
-                cuda.Device(device)
-                self.devices[device] = None  # not currently working
+            if len(worker_json.get('devices', [])) > 0:
+                cuda.init()
+                for device in worker_json['devices']:
+                    cuda.Device(device)
+                    self.devices[device] = None  # not currently working
+
+            for i, cores in enumerate(worker_json.get('cpu_devices', [])):
+                assert int(cores) > 0
+                self.devices[CPUDevice(i, int(cores))] = None
+
+            assert len(self.devices) > 0
         except Exception:
             logger.error(
                 "Device list not found in config file:  %s",
@@ -75,6 +135,42 @@ class Worker(Daemon):
             )
             sys.exit("Worker failed to start, see log file for details")
 
+        # look for optional pipeline queue depths
+        try:
+            if 'prepare_queue_depth' in worker_json:
+                self.prepare_queue_depth = int(
+                    worker_json['prepare_queue_depth']
+                )
+            if 'upload_queue_depth' in worker_json:
+                self.upload_queue_depth = int(
+                    worker_json['upload_queue_depth']
+                )
+            for option in self.options:
+                if option in worker_json:
+                    self.options[option] = int(worker_json[option])
+            assert self.prepare_queue_depth >= 0
+            assert self.upload_queue_depth >= 1
+            assert self.options['download_concurrency'] >= 1
+            assert self.options['preprocess_concurrency'] >= 1
+            assert self.options['preprocess_threads'] >= 1
+            assert self.options['upload_concurrency'] >= 1
+            assert self.options['sample_cache_size'] >= 0
+            assert self.options['subsample_cache_size'] >= 0
+            assert self.options['transformed_cache_size'] >= 0
+            assert self.options['components_cache_size'] >= 0
+
+            if 'persistent_devices' in worker_json:
+                self.persistent_devices = bool(
+                    worker_json['persistent_devices']
+                )
+        except Exception:
+            logger.error(
+                "Invalid processing options in config file:  %s",
+                WORKER_CONF,
+                exc_info=True
+            )
+            sys.exit("Worker failed to start, see log file for details")
+
         # look for the server protocol, http or https
         if 'method' in worker_json:
             self.method = utils.METHOD[worker_json['method']]
@@ -82,6 +178,15 @@ class Worker(Daemon):
             # default is https
             self.method = utils.METHOD['https']
 
+        # share keep-alive connections between all ReFlow server requests
+        rest_client.install(
+            max(
+                HTTP_POOL_SIZE,
+                self.options['download_concurrency'],
+                self.options['upload_concurrency']
+            )
+        )
+
         # verify worker with the host
         # catching all exceptions here, since if anything goes wrong
         # we should not continue
@@ -108,44 +213,335 @@ class Worker(Daemon):
 
         super(Worker, self).__init__(pid_file)
 
+    def _install_child_watcher(self):
+        """
+        Route SIGCHLD to a non-blocking pipe so the control loop can wake
+        up as soon as a WorkerProcess exits, rather than waiting for the
+        next polling interval.
+        """
+        read_fd, write_fd = os.pipe()
+        for fd in (read_fd, write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        # The handler itself does nothing, the interpreter writes a byte to
+        # the wakeup fd for every signal received. A handler (not SIG_DFL)
+        # must be installed for that to happen.
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        # restart system calls interrupted by SIGCHLD (e.g. socket reads
+        # while talking to the ReFlow server) instead of failing w/ EINTR
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(write_fd)
+
+        self.wakeup_fd = read_fd
+
+    def _wait(self, timeout):
+        """
+        Block until a child process exits, a DeviceProcess sends a result,
+        or the timeout (in seconds) expires, whichever comes first
+        """
+        fds = [self.wakeup_fd]
+        for p in self.device_processes.values():
+            # a dead process' pipe is always readable (EOF)
+            if p.is_alive():
+                fds.append(p.connection.fileno())
+
+        try:
+            readable = select.select(fds, [], [], timeout)[0]
+        except select.error as e:
+            # select is never restarted after a signal, which is fine
+            # since a signal is exactly what we are waiting for
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = [self.wakeup_fd]
+
+        if self.wakeup_fd in readable:
+            # drain the pipe, there's one byte per signal received
+            try:
+                while os.read(self.wakeup_fd, 512):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
     def _run(self):
         logger.info("Worker started")
 
+        self._install_child_watcher()
+
+        if self.persistent_devices:
+            for device in self.devices:
+                self._start_device_process(device)
+
+        # time of the next scheduled poll of the ReFlow server, start
+        # with an immediate poll
+        next_poll = time.time()
+        next_stats_log = time.time() + STATS_INTERVAL
+
         while True:
-            # check in on our children
-            working_requests = []
-            for p in multiprocessing.active_children():
-                if type(p) is WorkerProcess:
-                    working_requests.append(
-                        p.assigned_pr.process_request_id
+            # check in on our children & move their PRs to the next stage
+            stage_finished = self.reap_workers()
+            if self.reap_device_processes():
+                stage_finished = True
+
+            # hand out any locally queued work, no need to ask the server
+            self.schedule_stages()
+
+            # Talk to the server when the polling interval is up, or right
+            # away if a child just finished a stage and freed up capacity
+            if stage_finished or time.time() >= next_poll:
+                if self.get_capacity() > 0:
+                    # launch workers first in case the server already has
+                    # work assigned to this worker
+                    self.launch_workers()
+
+                    # request assignments for any free capacity, and if
+                    # the server granted any start them now rather than
+                    # waiting for the next poll
+                    if self.request_assignments() > 0:
+                        self.launch_workers()
+
+                next_poll = time.time() + DEFAULT_SLEEP
+
+            if time.time() >= next_stats_log:
+                stats.log("Worker")
+                next_stats_log = time.time() + STATS_INTERVAL
+
+            self._wait(max(next_poll - time.time(), 0))
+
+    def _start_device_process(self, device):
+        process = DeviceProcess(
+            self.host,
+            self.token,
+            self.method,
+            device
+        )
+        process.start()
+        process.start_time = time.time()
+        self.device_processes[device] = process
+
+    def reap_device_processes(self):
+        """
+        Collects results sent by the DeviceProcess instances, freeing their
+        devices & queueing successful PRs for upload. Any DeviceProcess
+        that died is restarted, and the PR it was working on is reported
+        as failed.
+
+        Returns True if any device was freed
+        """
+        device_freed = False
+
+        for device, process in self.device_processes.items():
+            try:
+                while process.connection.poll():
+                    pr_id, success = process.connection.recv()
+                    self.devices[device] = None
+                    device_freed = True
+
+                    if success:
+                        self.upload_queue.append(pr_id)
+                    else:
+                        logger.warning(
+                            "(PR: %s) %s stage did not complete",
+                            str(pr_id),
+                            STAGE_CLUSTER
+                        )
+            except (EOFError, IOError):
+                # the process died, handled below
+                pass
+
+            if process.is_alive():
+                continue
+
+            process.join()
+
+            pr_id = self.devices[device]
+            if pr_id is not None:
+                # the process couldn't report this itself
+                try:
+                    utils.report_pr_error(
+                        self.host,
+                        self.token,
+                        pr_id,
+                        "Device process failed during clustering",
+                        method=self.method
                     )
+                except Exception as e:
+                    logger.error(str(e))
+                self.devices[device] = None
+                device_freed = True
 
-            # free any devices that are no longer working
-            for gpu_id in self.devices:
-                if self.devices[gpu_id] not in working_requests:
-                    self.devices[gpu_id] = None
+            # avoid restarting a process that fails right away (e.g. the
+            # device context can't be created) in a tight loop, it will be
+            # retried on a later pass
+            if time.time() - process.start_time < DEFAULT_SLEEP:
+                continue
 
-            if len(working_requests) < len(self.devices):
-                # launch workers first in case the server already has
-                # work assigned to this worker
-                self.launch_workers()
+            logger.error(
+                "Restarting device %s process, exit code %s",
+                str(device),
+                str(process.exitcode)
+            )
+            try:
+                self._start_device_process(device)
+            except Exception as e:
+                logger.error(str(e), exc_info=True)
 
-                # request assignments for any free GPU devices
-                self.request_assignments()
+        return device_freed
 
-            time.sleep(DEFAULT_SLEEP)
+    def _start_process(self, pr_id, stage, device=None):
+        """
+        Starts a WorkerProcess for the given PR stage. Returns True if the
+        process was started.
+        """
+        try:
+            process = WorkerProcess(
+                self.host,
+                self.token,
+                self.method,
+                pr_id,
+                stage,
+                device,
+                self.options
+            )
+            process.start()
+        except Exception as e:
+            logger.error(
+                str(e),
+                exc_info=True
+            )
+            return False
+
+        self.processes[pr_id] = process
+        if device is not None:
+            self.devices[device] = pr_id
+
+        return True
+
+    def reap_workers(self):
+        """
+        Joins any finished WorkerProcess instances, freeing their devices,
+        and queues their PRs for the next stage if the stage succeeded.
+        A failed stage has already reported its errors to the ReFlow server,
+        so the PR is simply dropped.
+
+        Returns True if any process finished
+        """
+        finished = False
+
+        for pr_id, process in self.processes.items():
+            if process.is_alive():
+                continue
+
+            process.join()
+            del self.processes[pr_id]
+            finished = True
+
+            if process.stage == STAGE_CLUSTER:
+                self.devices[process.device] = None
+
+            if process.exitcode != 0:
+                logger.warning(
+                    "(PR: %s) %s stage did not complete, exit code %s",
+                    str(pr_id),
+                    process.stage,
+                    str(process.exitcode)
+                )
+                continue
+
+            if process.stage == STAGE_PREPARE:
+                self.ready_queue.append(pr_id)
+            elif process.stage == STAGE_CLUSTER:
+                self.upload_queue.append(pr_id)
+
+        return finished
+
+    def schedule_stages(self):
+        """
+        Starts the cluster stage for prepared PRs on any free devices, and
+        the upload stage for clustered PRs as upload slots become free.
+        """
+        available_devices = self.get_available_devices()
+
+        while len(self.ready_queue) > 0 and len(available_devices) > 0:
+            pr_id = self.ready_queue.pop(0)
+            device = available_devices.pop(0)
+
+            if not self.persistent_devices:
+                self._start_process(pr_id, STAGE_CLUSTER, device)
+                continue
+
+            try:
+                self.device_processes[device].dispatch(pr_id)
+                self.devices[device] = pr_id
+            except Exception as e:
+                # the DeviceProcess will be restarted, keep the PR queued
+                logger.error(str(e), exc_info=True)
+                self.ready_queue.insert(0, pr_id)
+                break
+
+        uploading = [
+            p for p in self.processes.values() if p.stage == STAGE_UPLOAD
+        ]
+        upload_slots = self.upload_queue_depth - len(uploading)
+
+        while len(self.upload_queue) > 0 and upload_slots > 0:
+            pr_id = self.upload_queue.pop(0)
+            if self._start_process(pr_id, STAGE_UPLOAD):
+                upload_slots -= 1
 
     def get_available_devices(self):
         available_devices = []
         for gpu_id in self.devices:
-            if self.devices[gpu_id] is None:
-                available_devices.append(gpu_id)
+            if self.devices[gpu_id] is not None:
+                continue
+            if self.persistent_devices and \
+                    not self.device_processes[gpu_id].is_alive():
+                # waiting to be restarted
+                continue
+            available_devices.append(gpu_id)
         return available_devices
 
+    def get_pending_requests(self):
+        """
+        Returns list of PR PKs this worker is currently handling in any stage
+        """
+        pending = self.processes.keys()
+        pending.extend(
+            [pr_id for pr_id in self.devices.values() if pr_id is not None]
+        )
+        pending.extend(self.ready_queue)
+        pending.extend(self.upload_queue)
+
+        return pending
+
+    def get_capacity(self):
+        """
+        Returns the number of new PRs the worker can take on. Every device
+        can be clustering a PR, with up to prepare_queue_depth more PRs
+        being pre-processed ahead of time.
+        """
+        in_flight = len(self.ready_queue)
+        for p in self.processes.values():
+            if p.stage == STAGE_PREPARE:
+                in_flight += 1
+        for pr_id in self.devices.values():
+            if pr_id is not None:
+                in_flight += 1
+
+        return len(self.devices) + self.prepare_queue_depth - in_flight
+
     def request_assignments(self):
-        available_devices = self.get_available_devices()
+        """
+        Request PR assignments from the ReFlow server for any free capacity
+
+        Returns the number of assignments requested
+        """
+        capacity = self.get_capacity()
+        request_count = 0
 
-        if len(available_devices) > 0:
+        if capacity > 0:
             try:
                 viable_requests = utils.get_viable_process_requests(
                     self.host,
@@ -153,9 +549,9 @@ class Worker(Daemon):
                     method=self.method
                 )
                 for request in viable_requests['data']:
-                    # Request assignments for the number of available devices
-                    if len(available_devices) <= 0:
-                        return
+                    # Request assignments for the available capacity
+                    if request_count >= capacity:
+                        break
 
                     # request ProcessRequest assignment
                     logger.info(
@@ -168,16 +564,17 @@ class Worker(Daemon):
                         request['id'],
                         method=self.method
                     )
-                    available_devices.pop()
+                    request_count += 1
             except Exception:
                 logger.error(
                     "Error trying to request assignments",
                     exc_info=True
                 )
-                return
+
+        return request_count
 
     def launch_workers(self):
-        # If we get here then there are devices available for processing.
+        # If we get here then there is capacity for more processing.
         # First, see if the ReFlow server already has stuff assigned to us
         try:
             query_assignment_response = utils.get_assigned_process_requests(
@@ -193,43 +590,18 @@ class Worker(Daemon):
             return
 
         # iterate through assigned PRs
+        pending_requests = self.get_pending_requests()
         for pr in query_assignment_response['data']:
             # check if the PR is already being worked on
-            if pr['id'] in self.devices.values():
+            if pr['id'] in pending_requests:
                 continue
 
-            # see if we have an available device
-            available_devices = self.get_available_devices()
-
-            if len(available_devices) <= 0:
+            if self.get_capacity() <= 0:
                 return
 
-            gpu_id = available_devices.pop(0)
-            try:
-                process = WorkerProcess(
-                    self.host,
-                    self.token,
-                    self.method,
-                    pr['id'],
-                    gpu_id
-                )
-            except Exception as e:
-                logger.error(
-                    str(e),
-                    exc_info=True
-                )
-                # just skip this WorkerProcess
-                continue
-
-            try:
-                process.start()
-                self.devices[gpu_id] = pr['id']
-            except Exception as e:
-                logger.error(
-                    str(e),
-                    exc_info=True
-                )
-                continue
+            # start by downloading & pre-processing, the PR will be queued
+            # for a device once that's done
+            self._start_process(pr['id'], STAGE_PREPARE)
 
 if __name__ == "__main__":
     usage = "usage: %s start|stop|restart" % sys.argv[0]
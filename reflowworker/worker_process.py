@@ -1,32 +1,84 @@
 import multiprocessing
+import signal
+import sys
+import time
 
 from reflowrestclient import utils
 
 from logger import logger
+from clustering_processes import preload_flowstats, create_device_context
+from cpu_cluster import CPUDevice
 from process_request import ProcessRequest
 from processing_error import ProcessingError
+from stats import stats
+
+# The processing stages of a ProcessRequest, see Worker for details
+STAGE_PREPARE = 'prepare'
+STAGE_CLUSTER = 'cluster'
+STAGE_UPLOAD = 'upload'
 
 
 class WorkerProcess(multiprocessing.Process):
-    def __init__(self, host, token, method, assigned_pr_id, gpu_id):
+    """
+    Runs a single processing stage of a ProcessRequest. Between stages the
+    ProcessRequest is saved to its working directory, so each stage can
+    run in a separate process. Exits with a non-zero exit code if the stage
+    failed, any errors will have been reported to the ReFlow server.
+    """
+    def __init__(
+            self,
+            host,
+            token,
+            method,
+            assigned_pr_id,
+            stage,
+            device,
+            options=None):
         super(WorkerProcess, self).__init__()
         self.daemon = True
         self.host = host
         self.token = token
         self.method = method
-        self.device = gpu_id
+        self.stage = stage
+        self.device = device
+        self.assigned_pr_id = assigned_pr_id
+        # processing options for the ProcessRequest
+        self.options = options
 
-        logger.info(
-            "ProcessRequest %s assigned to GPU %d",
-            str(assigned_pr_id),
-            self.device
-        )
+        # used to measure the startup overhead of the cluster stage
+        self.launch_time = time.time()
 
+        # the ProcessRequest is built in run() so the parent Worker doesn't
+        # block fetching the sample collection & site panels
+        self.assigned_pr = None
+
+        if assigned_pr_id is None:
+            # a DeviceProcess, PRs are logged as they're dispatched
+            pass
+        elif self.stage == STAGE_CLUSTER:
+            logger.info(
+                "ProcessRequest %s assigned to device %s",
+                str(assigned_pr_id),
+                str(self.device)
+            )
+        else:
+            logger.info(
+                "ProcessRequest %s starting %s stage",
+                str(assigned_pr_id),
+                self.stage
+            )
+
+    def _create_process_request(self):
+        """
+        Retrieves the assigned PR from the ReFlow server and creates the
+        ProcessRequest instance. Returns True on success, any errors are
+        reported back to the ReFlow server.
+        """
         try:
             pr_response = utils.get_process_request(
                 self.host,
                 self.token,
-                assigned_pr_id,
+                self.assigned_pr_id,
                 method=self.method
             )
 
@@ -34,25 +86,85 @@ class WorkerProcess(multiprocessing.Process):
                 self.host,
                 self.token,
                 pr_response['data'],
-                self.method
+                self.method,
+                self.options
             )
         except ProcessingError as e:
             # any ProcessingError should have already been logged,
-            # so just report it back to the ReFlow server.
-            # Also, re-raise a ProcessingError so the Worker can avoid
-            # running this analysis
+            # so just report it back to the ReFlow server
             self.report_errors(e.message)
-            raise ProcessingError("Fatal error creating WorkerProcess")
+            return False
         except Exception, e:
             logger.error(str(e))
             self.report_errors(
                 "Unknown error occurred parsing ProcessRequest from server"
             )
-            raise ProcessingError("Fatal error creating WorkerProcess")
+            return False
+
+        return True
+
+    def _load_process_request(self):
+        """
+        Loads the ProcessRequest saved by the previous stage. Returns True
+        on success, any errors are reported back to the ReFlow server.
+        """
+        try:
+            self.assigned_pr = ProcessRequest.load_state(
+                self.host,
+                self.assigned_pr_id,
+                self.token
+            )
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+            self.report_errors(
+                "Unknown error occurred loading ProcessRequest state"
+            )
+            return False
+
+        return True
 
     def run(self):
+        # We inherited the Worker's SIGCHLD wakeup pipe when forked,
+        # restore the defaults so we don't wake the Worker spuriously
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        # don't count anything the Worker did before we were forked
+        stats.reset()
+
+        if self.stage == STAGE_PREPARE:
+            success = self._run_prepare()
+        elif self.stage == STAGE_CLUSTER:
+            if not isinstance(self.device, CPUDevice):
+                preload_flowstats()
+            success = self._run_cluster(self.launch_time)
+        elif self.stage == STAGE_UPLOAD:
+            success = self._run_upload()
+        else:
+            logger.error("Unknown processing stage: %s", str(self.stage))
+            success = False
+
+        stats.log(
+            "(PR: %s) %s stage" % (str(self.assigned_pr_id), self.stage)
+        )
+
+        if not success:
+            # let the Worker know this PR shouldn't continue
+            sys.exit(1)
+
+    def _run_prepare(self):
+        # ProcessRequest._pre_process() runs a multiprocessing Pool, but
+        # multiprocessing refuses to start children from a daemonic process.
+        # The flag only matters to our copy of this Process object (the
+        # Worker still terminates us as a daemon), and the pool's processes
+        # are always terminated before pre-processing returns, so none can
+        # outlive this stage.
+        multiprocessing.current_process().daemon = False
+
         # We've got something to do!
-        #
+        if not self._create_process_request():
+            return False
+
         # Before we start anything, we need to purge any prior ProcessRequest
         # results on the ReFlow server. This is necessary in the unlikely
         # case that the job had previously been worked on and a partial set
@@ -70,26 +182,64 @@ class WorkerProcess(multiprocessing.Process):
             self.report_errors(
                 "Unknown error occurred purging ProcessRequest results"
             )
-            raise ProcessingError("Fatal error creating WorkerProcess")
+            return False
 
         if purge_response['status'] != 200:
             self.report_errors(
                 "Unknown error occurred purging ProcessRequest results"
             )
-            raise ProcessingError("Fatal error creating WorkerProcess")
+            return False
+
+        # now we can start downloading & pre-processing
+        try:
+            self.assigned_pr.prepare()
+            self.assigned_pr.save_state()
+        except ProcessingError as e:
+            # any ProcessingError should have already been logged,
+            # so just report it back to the ReFlow server
+            self.report_errors(e.message)
+            return False
+        except Exception as e:
+            logger.error(str(e))
+            self.report_errors("Unknown error occurred during processing")
+            return False
+
+        return True
+
+    def _run_cluster(self, dispatch_time):
+        if not self._load_process_request():
+            return False
+
+        # Record the time from the Worker handing us the PR until we're
+        # ready to cluster. For a WorkerProcess started per PR this includes
+        # starting the process & importing flowstats.
+        overhead = time.time() - dispatch_time
+        stats.record('device_startup_overhead', overhead)
+        logger.info(
+            "(PR: %s) Device %s startup overhead: %.3f seconds",
+            str(self.assigned_pr_id),
+            str(self.device),
+            overhead
+        )
 
-        # now we can start analyzing
         try:
-            self.assigned_pr.analyze(self.device)
+            self.assigned_pr.cluster(self.device)
+            self.assigned_pr.save_state()
         except ProcessingError as e:
             # any ProcessingError should have already been logged,
             # so just report it back to the ReFlow server
             self.report_errors(e.message)
-            return
+            return False
         except Exception as e:
             logger.error(str(e))
             self.report_errors("Unknown error occurred during processing")
-            return
+            return False
+
+        return True
+
+    def _run_upload(self):
+        if not self._load_process_request():
+            return False
 
         # Verify assignment
         try:
@@ -102,13 +252,13 @@ class WorkerProcess(multiprocessing.Process):
             if not verify_assignment_response['data']['assignment']:
                 # we're not assigned anymore, no need to report errors
                 # just return
-                return
+                return False
         except Exception as e:
             logger.error(str(e))
             self.report_errors(
                 "Unknown error occurred verifying assignment after processing"
             )
-            return
+            return False
 
         # Upload results
         try:
@@ -117,13 +267,13 @@ class WorkerProcess(multiprocessing.Process):
             # any ProcessingError should have already been logged,
             # so just report it back to the ReFlow server
             self.report_errors(e.message)
-            return
+            return False
         except Exception, e:
             logger.error(str(e))
             self.report_errors(
                 "Unknown error occurred saving cluster results to server"
             )
-            return
+            return False
 
         # Report the ProcessRequest is complete
         try:
@@ -142,7 +292,7 @@ class WorkerProcess(multiprocessing.Process):
             self.report_errors(
                 "Unknown error occurred attempting to mark request 'Complete'"
             )
-            return
+            return False
 
         logger.info(
             "(PR: %s) ProcessRequest marked as complete",
@@ -157,6 +307,8 @@ class WorkerProcess(multiprocessing.Process):
             str(self.assigned_pr.process_request_id)
         )
 
+        return True
+
     def report_errors(self, message):
         """
         Report an error back to the ReFlow server. This will update the
@@ -166,10 +318,92 @@ class WorkerProcess(multiprocessing.Process):
             utils.report_pr_error(
                 self.host,
                 self.token,
-                self.assigned_pr.process_request_id,
+                self.assigned_pr_id,
                 message,
                 method=self.method
             )
         except Exception as e:
             # Not much we can do except log the error locally to trouble-shoot
             logger.error(str(e))
+
+
+class DeviceProcess(WorkerProcess):
+    """
+    A long-lived process running the cluster stage for a single device.
+    For a GPU, flowstats is imported and the CUDA context created once when
+    the process starts, then PR PKs are received from the Worker over a pipe.
+    For each PR, a tuple of (PR PK, success) is sent back to the Worker.
+    """
+    def __init__(self, host, token, method, device):
+        super(DeviceProcess, self).__init__(
+            host,
+            token,
+            method,
+            None,
+            STAGE_CLUSTER,
+            device
+        )
+
+        # the Worker's end of the pipe is self.connection
+        self.connection, self.child_connection = multiprocessing.Pipe()
+
+    def start(self):
+        super(DeviceProcess, self).start()
+
+        # the child's end of the pipe is only used by the child
+        self.child_connection.close()
+
+    def dispatch(self, pr_id):
+        """
+        Called by the Worker to hand a prepared PR to this device
+        """
+        logger.info(
+            "ProcessRequest %s assigned to device %s",
+            str(pr_id),
+            str(self.device)
+        )
+        self.connection.send((pr_id, time.time()))
+
+    def run(self):
+        # We inherited the Worker's SIGCHLD wakeup pipe when forked,
+        # restore the defaults so we don't wake the Worker spuriously
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        # don't count anything the Worker did before we were forked
+        stats.reset()
+
+        # the Worker's end of the pipe is only used by the Worker
+        self.connection.close()
+
+        start_time = time.time()
+        if isinstance(self.device, CPUDevice):
+            context = None
+        else:
+            preload_flowstats()
+            context = create_device_context(self.device)
+
+        logger.info(
+            "Device %s process ready in %.3f seconds",
+            str(self.device),
+            time.time() - start_time
+        )
+
+        try:
+            while True:
+                try:
+                    pr_id, dispatch_time = self.child_connection.recv()
+                except EOFError:
+                    # the Worker is gone
+                    break
+
+                self.assigned_pr_id = pr_id
+                self.assigned_pr = None
+
+                success = self._run_cluster(dispatch_time)
+                stats.log("(PR: %s) %s stage" % (str(pr_id), self.stage))
+                self.child_connection.send((pr_id, success))
+        finally:
+            if context is not None:
+                context.pop()
+                context.detach()
@@ -12,10 +12,13 @@ setup(
     install_requires=[
         'requests (>=1.1.0)',
         'numpy (>=1.6)',
-        'pycuda (>=2013.1.1)',
         'reflowrestclient (==0.3)',
         'flowio (==0.6)',
         'flowutils (==0.3)',
         'flowstats (==0.7)'
-    ]
+    ],
+    extras_require={
+        # only needed for GPU devices, see the 'cpu_devices' setting
+        'gpu': ['pycuda (>=2013.1.1)']
+    }
 )
\ No newline at end of file
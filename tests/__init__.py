@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The reflowworker modules import each other as top level modules, so they
+# are imported the same way here, as done by the Worker daemon
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'reflowworker'))
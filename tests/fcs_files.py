@@ -0,0 +1,71 @@
+import numpy as np
+
+# type codes of the DATA segment values for each $DATATYPE
+_TYPE_CODES = {'I': 'u', 'F': 'f', 'D': 'f'}
+
+
+def fcs_bytes(events, datatype='F', bit_width=32, byte_order='<'):
+    """
+    Returns the bytes of a minimal list mode FCS 3.1 file holding the given
+    (events x channels) array, with every channel stored using the given
+    $DATATYPE, bit width, and byte order ('<' or '>')
+    """
+    event_count, channel_count = events.shape
+
+    dtype = np.dtype(
+        byte_order + _TYPE_CODES[datatype] + str(bit_width // 8)
+    )
+    data = events.astype(dtype).tostring()
+
+    keywords = [
+        ('$BYTEORD', '1,2,3,4' if byte_order == '<' else '4,3,2,1'),
+        ('$DATATYPE', datatype),
+        ('$MODE', 'L'),
+        ('$NEXTDATA', '0'),
+        ('$PAR', str(channel_count)),
+        ('$TOT', str(event_count))
+    ]
+    for i in range(1, channel_count + 1):
+        keywords.extend(
+            [
+                ('$P%dB' % i, str(bit_width)),
+                ('$P%dE' % i, '0,0'),
+                ('$P%dN' % i, 'C%d' % i),
+                ('$P%dR' % i, str(2 ** min(bit_width, 32)))
+            ]
+        )
+
+    # fixed width offsets, so the TEXT length doesn't depend on them
+    def text_segment(data_start, data_end):
+        pairs = keywords + [
+            ('$BEGINDATA', '%012d' % data_start),
+            ('$ENDDATA', '%012d' % data_end)
+        ]
+        return '/' + ''.join('%s/%s/' % pair for pair in pairs)
+
+    text_start = 58
+    data_start = text_start + len(text_segment(0, 0))
+    data_end = data_start + len(data) - 1
+    text = text_segment(data_start, data_end)
+
+    header = 'FCS3.1    %8d%8d%8d%8d%8d%8d' % (
+        text_start,
+        data_start - 1,
+        data_start,
+        data_end,
+        0,
+        0
+    )
+
+    return header + text + data
+
+
+def write_fcs(file_path, events, datatype='F', bit_width=32, byte_order='<'):
+    """
+    Writes a minimal FCS file, see fcs_bytes()
+    """
+    fcs_file = open(file_path, 'wb')
+    try:
+        fcs_file.write(fcs_bytes(events, datatype, bit_width, byte_order))
+    finally:
+        fcs_file.close()
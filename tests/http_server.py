@@ -0,0 +1,72 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded stand-in for a ReFlow API on a free local port. Each GET
+    calls respond(path) after the given delay, which returns None for a
+    404, or a (body, headers) tuple. The concurrent requests are tracked.
+    """
+    daemon_threads = True
+
+    def __init__(self, respond, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self,
+            ('127.0.0.1', 0),
+            StubRequestHandler
+        )
+        self.respond = respond
+        self.latency = latency
+
+        self.lock = threading.Lock()
+        self.active_requests = 0
+        self.max_active_requests = 0
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active_requests += 1
+            server.max_active_requests = max(
+                server.max_active_requests,
+                server.active_requests
+            )
+
+        try:
+            time.sleep(server.latency)
+
+            response = server.respond(self.path)
+            if response is None:
+                self.send_error(404)
+                return
+
+            body, headers = response
+            self.send_response(200)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active_requests -= 1
+
+    def log_message(self, *args):
+        pass
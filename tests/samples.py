@@ -0,0 +1,24 @@
+def sample_dict(sample_pk, sha1, site_panel_id=1):
+    """
+    Returns a ReFlow sample 'data' dictionary for the Sample constructor
+    """
+    return {
+        'id': sample_pk,
+        'acquisition_date': '2014-01-01',
+        'original_filename': '%d.fcs' % sample_pk,
+        'sha1': sha1,
+        'exclude': False,
+        'site': 1,
+        'site_name': 'site',
+        'specimen': 1,
+        'specimen_name': 'specimen',
+        'stimulation': 1,
+        'stimulation_name': 'stimulation',
+        'storage': 'Fresh',
+        'pretreatment': 'In vitro',
+        'visit': 1,
+        'visit_name': 'visit',
+        'subject': 1,
+        'subject_code': 'subject',
+        'site_panel': site_panel_id
+    }
@@ -0,0 +1,96 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from clustering_processes import hdp
+from cpu_cluster import CPUDevice
+
+SITE_PANEL_ID = 1
+CENTERS = np.array([[0.0, 0.0], [6.0, 0.0], [0.0, 6.0]])
+
+
+class FakeSample(object):
+    def __init__(self, sample_id, directory, labels, rng):
+        self.sample_id = sample_id
+        self.site_panel_id = SITE_PANEL_ID
+        self.labels = labels
+
+        events = CENTERS[labels] + rng.standard_normal((len(labels), 2)) * 0.5
+        self.subsample_indices = np.arange(len(labels)) * 2
+        self.preprocessed_path = '%s/pre_%d.npy' % (directory, sample_id)
+        self.normalized_path = '%s/norm_%d.npy' % (directory, sample_id)
+        np.save(self.preprocessed_path, events)
+        np.save(self.normalized_path, events)
+
+
+class FakeProcessRequest(object):
+    def __init__(self, samples):
+        self.samples = samples
+        self.panel_maps = {SITE_PANEL_ID: [0, 1]}
+        self.clustering_options = {
+            'iteration_count': '10',
+            'cluster_count': '8',
+            'burnin': '40',
+            'random_seed': '1'
+        }
+        self.progress = list()
+
+    def report_pr_progress(self, percent_complete):
+        self.progress.append(percent_complete)
+
+
+class CPUClusteringTestCase(unittest.TestCase):
+    """
+    hdp() on a CPU device must recover the clusters of a simple, well
+    separated mixture
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _create_samples(self, sample_count):
+        samples = list()
+        for i in range(sample_count):
+            labels = self.rng.randint(0, len(CENTERS), 600)
+            samples.append(FakeSample(i + 1, self.directory, labels, self.rng))
+
+        return samples
+
+    def _assert_recovered(self, sample_count):
+        samples = self._create_samples(sample_count)
+        process_request = FakeProcessRequest(samples)
+
+        clusters = hdp(process_request, CPUDevice(0, 2))
+        self.assertEqual(process_request.progress[-1], 100.0)
+
+        # Each true cluster's events must all be in a single cluster. There
+        # may be extra clusters w/o any events, made from unused components
+        for s in samples:
+            found = np.empty(len(s.labels), dtype=np.int64)
+            for cluster in clusters:
+                sample_clusters = [
+                    sc for sc in cluster.sample_clusters
+                    if sc.sample_id == s.sample_id
+                ]
+                self.assertEqual(len(sample_clusters), 1)
+                events = sample_clusters[0].events
+                found[events[:, 0].astype(np.int64) // 2] = cluster.index
+
+            for label in range(len(CENTERS)):
+                self.assertEqual(len(set(found[s.labels == label])), 1)
+            self.assertEqual(len(set(found)), len(CENTERS))
+
+    def test_dp(self):
+        self._assert_recovered(1)
+
+    def test_hdp(self):
+        self._assert_recovered(3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+
+from cpu_cluster import ModalMixture
+
+
+def _densities(x, mu, sigma):
+    diff = x - mu
+    mahalanobis = np.einsum(
+        'ni,ij,nj->n',
+        diff,
+        np.linalg.inv(sigma),
+        diff
+    )
+    norm = np.sqrt((2 * np.pi) ** len(mu) * np.linalg.det(sigma))
+
+    return np.exp(-0.5 * mahalanobis) / norm
+
+
+class ModalMixtureTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        n_dim = 3
+        self.mus = rng.randn(5, n_dim) * 2
+        a = rng.randn(5, n_dim, n_dim) * 0.5
+        self.sigmas = np.einsum('kij,klj->kil', a, a) + np.eye(n_dim)
+        self.pis = rng.dirichlet(np.ones(5), 1)
+        self.cmap = {0: [0, 3], 1: [1], 2: [2, 4]}
+        self.x = rng.randn(2000, n_dim) * 3
+
+    def test_classify_sums_mode_components(self):
+        mixture = ModalMixture(
+            self.pis,
+            self.mus,
+            self.sigmas,
+            self.cmap,
+            dict()
+        )
+
+        weighted = np.array(
+            [
+                self.pis[0, k] * _densities(self.x, self.mus[k], s)
+                for k, s in enumerate(self.sigmas)
+            ]
+        ).T
+        mode_densities = np.array(
+            [weighted[:, self.cmap[m]].sum(axis=1) for m in range(3)]
+        ).T
+
+        np.testing.assert_array_equal(
+            mixture.classify(self.x),
+            np.argmax(mode_densities, axis=1)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import hashlib
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+from reflowrestclient import utils
+
+import process_request
+from panel_index import PanelIndex
+from process_request import ProcessRequest
+from processing_error import ProcessingError
+from sample_models import Sample
+from tests.fcs_files import fcs_bytes
+from tests.http_server import StubServer
+from tests.samples import sample_dict
+
+SITE_PANEL_ID = 1
+CHANNEL_COUNT = 3
+LATENCY = 0.25
+
+
+def _respond(files, path):
+    """
+    Stand-in for the ReFlow sample download API, serving FCS files by
+    sample PK
+    """
+    match = re.search(r'/(\d+)/download', path)
+    if match is None or int(match.group(1)) not in files:
+        return None
+
+    sample_pk = int(match.group(1))
+    headers = [
+        ('Content-Type', 'application/octet-stream'),
+        ('Content-Disposition', 'attachment; filename=%d.fcs' % sample_pk)
+    ]
+    return files[sample_pk], headers
+
+
+class DownloadSamplesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sample_cache_dir = process_request.SAMPLE_CACHE_DIR
+        process_request.SAMPLE_CACHE_DIR = self.directory + '/samples/'
+
+        rng = np.random.RandomState(0)
+        self.files = dict()
+        self.event_counts = dict()
+        for sample_pk in range(1, 7):
+            event_count = 100 * sample_pk
+            self.files[sample_pk] = fcs_bytes(
+                rng.randn(event_count, CHANNEL_COUNT)
+            )
+            self.event_counts[sample_pk] = event_count
+
+        self.server = StubServer(
+            lambda path: _respond(self.files, path),
+            LATENCY
+        )
+        self.server.start()
+
+        self.pr = ProcessRequest.__new__(ProcessRequest)
+        self.pr.host = self.server.host
+        self.pr.token = 'token'
+        self.pr.method = utils.METHOD['http']
+        self.pr.process_request_id = 1
+        self.pr.options = {'download_concurrency': 3}
+        self.pr.panel_indices = {
+            SITE_PANEL_ID: PanelIndex(
+                {
+                    'parameters': [
+                        {
+                            'fcs_number': i + 1,
+                            'parameter_type': 'FL',
+                            'parameter_value_type': 'A',
+                            'markers': [],
+                            'fluorochrome': None
+                        } for i in range(CHANNEL_COUNT)
+                    ]
+                }
+            )
+        }
+
+    def tearDown(self):
+        self.server.stop()
+        process_request.SAMPLE_CACHE_DIR = self.sample_cache_dir
+        shutil.rmtree(self.directory)
+
+    def _create_samples(self, sha1s):
+        compensation = np.vstack(
+            [np.arange(1, CHANNEL_COUNT + 1), np.eye(CHANNEL_COUNT)]
+        )
+
+        return [
+            Sample(
+                self.pr,
+                sample_dict(sample_pk, sha1, SITE_PANEL_ID),
+                compensation
+            ) for sample_pk, sha1 in sorted(sha1s.items())
+        ]
+
+    def test_concurrent_downloads(self):
+        samples = self._create_samples(
+            dict(
+                (sample_pk, hashlib.sha1(body).hexdigest())
+                for sample_pk, body in self.files.items()
+            )
+        )
+
+        start = time.time()
+        self.pr._download_samples(samples)
+        elapsed = time.time() - start
+
+        for s in samples:
+            self.assertEqual(s.event_count, self.event_counts[s.sample_id])
+            self.assertEqual(
+                open(s.fcs_path, 'rb').read(),
+                self.files[s.sample_id]
+            )
+
+        self.assertEqual(self.server.max_active_requests, 3)
+        self.assertLess(elapsed, len(samples) * LATENCY)
+
+    def test_failed_download(self):
+        sha1s = dict(
+            (sample_pk, hashlib.sha1(body).hexdigest())
+            for sample_pk, body in self.files.items()
+        )
+        sha1s[4] = hashlib.sha1('not the sample').hexdigest()
+        samples = self._create_samples(sha1s)
+
+        with self.assertRaises(ProcessingError) as context:
+            self.pr._download_samples(samples)
+
+        self.assertEqual(
+            context.exception.message,
+            "Downloading samples failed"
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
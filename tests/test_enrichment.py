@@ -0,0 +1,203 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import flowio
+import flowutils
+import numpy as np
+from flowstats.dp_cluster import DPCluster, DPMixture
+
+import process_request
+import sample_models
+from fcs_header import FCSHeader
+from panel_index import PanelIndex
+from process_request import ProcessRequest
+from sample_models import Sample, ASINH_PRE_SCALE
+from subsampling import SUBSAMPLE_V1
+from tests.fcs_files import write_fcs
+from tests.samples import sample_dict
+
+SITE_PANEL_ID = 1
+SAMPLE_ID = 9
+PARENT_CLUSTERS = [0, 2]
+
+# small chunks, so the events are classified in several chunks
+CHUNK_SIZE = 700
+
+
+def _panel():
+    params = list()
+    for i, param_type in enumerate(['FSC', 'SSC', 'FL', 'FL', 'FL']):
+        if param_type == 'FL':
+            markers = [{'name': 'CD%d' % i}]
+        else:
+            markers = []
+
+        params.append(
+            {
+                'fcs_number': i + 1,
+                'parameter_type': param_type,
+                'parameter_value_type': 'A',
+                'markers': markers,
+                'fluorochrome': None
+            }
+        )
+
+    return {'parameters': params}
+
+
+def _components():
+    """
+    Returns the ReFlow 'data' list of the sample's parent stage components,
+    over the fluorescence channels
+    """
+    rng = np.random.RandomState(3)
+    components = list()
+    for k in range(5):
+        lines = ['2,3,4'] + [
+            ','.join(repr(v) for v in row)
+            for row in np.eye(3) * (0.5 + 0.1 * k)
+        ]
+        components.append(
+            {
+                'cluster': k % 3,
+                'weight': 0.2,
+                'covariance_matrix': '\n'.join(lines),
+                'parameters': [
+                    {'channel': channel, 'location': rng.uniform(-2, 2)}
+                    for channel in [3, 4, 5]
+                ]
+            }
+        )
+
+    return components
+
+
+class EnrichmentTestCase(unittest.TestCase):
+    """
+    The 2nd stage sub-sample must be identical to the one chosen by the
+    original algorithm, which compensated the events w/ flowutils, collected
+    the enriched events' indices per component with np.where() into a list,
+    then shuffled the list. Compensating w/ the matrix inverse changes the
+    events by a few ULPs (see Sample.compensate_events), which only changes
+    the selection for an event within ~1e-12 of a component boundary.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.chunk_sizes = (
+            process_request.EVENT_CHUNK_SIZE,
+            sample_models.EVENT_CHUNK_SIZE
+        )
+        process_request.EVENT_CHUNK_SIZE = CHUNK_SIZE
+        sample_models.EVENT_CHUNK_SIZE = CHUNK_SIZE
+
+        # events spread over the transformed range of the components
+        rng = np.random.RandomState(0)
+        fcs_path = os.path.join(self.directory, 'sample.fcs')
+        write_fcs(
+            fcs_path,
+            np.sinh(rng.uniform(-3, 3, (5000, 5))) / ASINH_PRE_SCALE
+        )
+
+        self.pr = ProcessRequest.__new__(ProcessRequest)
+        self.pr.host = 'localhost'
+        self.pr.process_request_id = 2
+        self.pr.directory = self.directory
+        self.pr.options = {'preprocess_threads': 3}
+        self.pr.transformation = 'asinh'
+        self.pr.parent_clusters = PARENT_CLUSTERS
+        self.pr.subsample_mode = SUBSAMPLE_V1
+        self.pr.panel_indices = {SITE_PANEL_ID: PanelIndex(_panel())}
+        self.pr.panel_maps = {SITE_PANEL_ID: [2, 3, 4]}
+        self.pr.parent_components = {
+            SAMPLE_ID: ProcessRequest._parse_parent_components(_components())
+        }
+
+        compensation = np.vstack([[3, 4, 5], np.eye(3) + 0.1])
+        self.sample = Sample(
+            self.pr,
+            sample_dict(SAMPLE_ID, 'sha1', SITE_PANEL_ID),
+            compensation
+        )
+        self.sample.fcs_path = fcs_path
+        self.sample.fcs_header = FCSHeader(fcs_path)
+
+    def tearDown(self):
+        process_request.EVENT_CHUNK_SIZE, sample_models.EVENT_CHUNK_SIZE = \
+            self.chunk_sizes
+        shutil.rmtree(self.directory)
+
+    def _original_selection(self, random_seed, subsample_count):
+        """
+        Returns the sub-sample indices & events chosen by the original,
+        list based algorithm
+        """
+        s = self.sample
+        flow_data = flowio.FlowData(s.fcs_path)
+        events = np.reshape(flow_data.events, (-1, flow_data.channel_count))
+        events = flowutils.compensate.compensate(
+            events,
+            s.compensation[1:, :],
+            [int(i) - 1 for i in s.compensation[0, :]]
+        )
+        data = s.apply_asinh_transform(events)
+
+        dp_clusters = list()
+        enrich_components = list()
+        for i, comp in enumerate(_components()):
+            if comp['cluster'] in PARENT_CLUSTERS:
+                enrich_components.append(i)
+
+            covariance = [
+                [float(v) for v in line.split(',')]
+                for line in comp['covariance_matrix'].splitlines()
+            ]
+            indices = [int(v) for v in covariance.pop(0)]
+            locations = list()
+            for index in indices:
+                for param in comp['parameters']:
+                    if param['channel'] - 1 == index:
+                        locations.append(param['location'])
+            dp_clusters.append(
+                DPCluster(comp['weight'], locations, np.array(covariance))
+            )
+
+        classifications = DPMixture(dp_clusters).classify(data[:, indices])
+
+        enrich_indices = []
+        for ec in enrich_components:
+            enrich_indices.extend(np.where(classifications == ec)[0])
+
+        rng = np.random.RandomState()
+        rng.seed(random_seed)
+        rng.shuffle(enrich_indices)
+        subsample_indices = enrich_indices[:subsample_count]
+
+        return subsample_indices, data[subsample_indices]
+
+    def test_identical_subsample(self):
+        for random_seed in [1, 2, 99]:
+            for subsample_count in [10, 1000, 10 ** 6]:
+                self.pr.random_seed = random_seed
+                self.pr.subsample_count = subsample_count
+                self.pr._pre_process_stage2(self.sample)
+
+                indices, events = self._original_selection(
+                    random_seed,
+                    subsample_count
+                )
+                self.assertEqual(self.sample.subsample_indices.dtype, np.int64)
+                np.testing.assert_array_equal(
+                    self.sample.subsample_indices,
+                    indices
+                )
+                # not equal, the compensation differs by a few ULPs
+                np.testing.assert_allclose(
+                    np.load(self.sample.preprocessed_path),
+                    events
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import flowio
+import numpy as np
+
+from fcs_header import FCSHeader
+from tests.fcs_files import write_fcs
+
+
+class MapEventsTestCase(unittest.TestCase):
+    """
+    The memory-mapped events must match the events parsed by flowio
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rng = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _assert_matches_flowio(self, events, datatype, bit_width, byte_order):
+        file_path = os.path.join(self.directory, 'sample.fcs')
+        write_fcs(file_path, events, datatype, bit_width, byte_order)
+
+        header = FCSHeader(file_path)
+        mapped = header.map_events(file_path)
+        self.assertIsNotNone(mapped)
+
+        flow_data = flowio.FlowData(file_path)
+        expected = np.reshape(flow_data.events, (-1, flow_data.channel_count))
+
+        actual = mapped.astype(header.get_event_dtype())
+        self.assertEqual(actual.dtype, expected.dtype)
+        np.testing.assert_array_equal(actual, expected)
+
+    def _int_events(self, bit_width):
+        return self.rng.randint(0, 2 ** bit_width - 1, (500, 4))
+
+    def test_float(self):
+        for byte_order in ['<', '>']:
+            self._assert_matches_flowio(
+                self.rng.randn(500, 4) * 1000,
+                'F',
+                32,
+                byte_order
+            )
+
+    def test_double(self):
+        for byte_order in ['<', '>']:
+            self._assert_matches_flowio(
+                self.rng.randn(500, 4) * 1000,
+                'D',
+                64,
+                byte_order
+            )
+
+    def test_int_little_endian(self):
+        for bit_width in [8, 16, 32]:
+            self._assert_matches_flowio(
+                self._int_events(min(bit_width, 31)),
+                'I',
+                bit_width,
+                '<'
+            )
+
+    def test_int_big_endian(self):
+        for bit_width in [8, 16, 32]:
+            self._assert_matches_flowio(
+                self._int_events(min(bit_width, 31)),
+                'I',
+                bit_width,
+                '>'
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
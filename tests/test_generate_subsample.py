@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import flowio
+import numpy as np
+
+import sample_models
+from fcs_header import FCSHeader
+from panel_index import PanelIndex
+from process_request import ProcessRequest
+from sample_models import Sample
+from subsampling import draw_subsample, SUBSAMPLE_V1, SUBSAMPLE_V2
+from tests.fcs_files import write_fcs
+from tests.samples import sample_dict
+
+SITE_PANEL_ID = 1
+EVENT_COUNT = 5000
+
+# small chunks, so the scatter channels are scanned in several chunks
+CHUNK_SIZE = 700
+
+
+def _panel():
+    params = list()
+    for i, param_type in enumerate(['FSC', 'FL', 'SSC', 'FL', 'TIM']):
+        params.append(
+            {
+                'fcs_number': i + 1,
+                'parameter_type': param_type,
+                'parameter_value_type': 'A',
+                'markers': [],
+                'fluorochrome': None
+            }
+        )
+
+    return {'parameters': params}
+
+
+class GenerateSubsampleTestCase(unittest.TestCase):
+    """
+    The 'v1' sub-sample must be identical to the one chosen by the
+    original algorithm, which deleted the negative scatter events from
+    np.arange(event_count), then shuffled the rest. The chunked 'v2'
+    sub-sample must be identical to drawing from that same array.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.chunk_size = sample_models.EVENT_CHUNK_SIZE
+        sample_models.EVENT_CHUNK_SIZE = CHUNK_SIZE
+
+        # about 1/5 of the events have a negative value in either scatter
+        # channel, the other channels are negative as often
+        rng = np.random.RandomState(0)
+        self.fcs_path = os.path.join(self.directory, 'sample.fcs')
+        write_fcs(self.fcs_path, rng.uniform(-100, 1000, (EVENT_COUNT, 5)))
+
+        pr = ProcessRequest.__new__(ProcessRequest)
+        pr.host = 'localhost'
+        pr.panel_indices = {SITE_PANEL_ID: PanelIndex(_panel())}
+
+        self.sample = Sample(
+            pr,
+            sample_dict(1, 'sha1', SITE_PANEL_ID),
+            np.vstack([[2, 4], np.eye(2)])
+        )
+        self.sample.fcs_path = self.fcs_path
+        self.sample.fcs_header = FCSHeader(self.fcs_path)
+
+    def tearDown(self):
+        sample_models.EVENT_CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.directory)
+
+    def _positive_indices(self):
+        flow_data = flowio.FlowData(self.fcs_path)
+        numpy_data = np.reshape(
+            flow_data.events,
+            (-1, flow_data.channel_count)
+        )
+        is_neg = (numpy_data[:, [0, 2]] < 0).any(axis=1)
+
+        return np.delete(np.arange(len(numpy_data)), np.where(is_neg)[0])
+
+    def _original_selection(self, subsample_count, random_seed):
+        """
+        Returns the sub-sample indices & events chosen by the original
+        algorithm
+        """
+        flow_data = flowio.FlowData(self.fcs_path)
+        numpy_data = np.reshape(
+            flow_data.events,
+            (-1, flow_data.channel_count)
+        )
+
+        is_neg = numpy_data[:, [0, 2]] < 0
+        is_neg = np.where(is_neg.any(axis=1))[0]
+
+        event_count = len(numpy_data)
+        if event_count - len(is_neg) < subsample_count:
+            subsample_count = event_count - len(is_neg)
+
+        shuffled_indices = np.arange(event_count)
+        shuffled_indices = np.delete(shuffled_indices, is_neg)
+        rng = np.random.RandomState()
+        rng.seed(random_seed)
+        rng.shuffle(shuffled_indices)
+
+        subsample_indices = shuffled_indices[:subsample_count]
+
+        return subsample_indices, numpy_data[subsample_indices]
+
+    def test_identical_subsample(self):
+        for random_seed in [1, 2, 99]:
+            for subsample_count in [10, 1000, EVENT_COUNT]:
+                subsample = self.sample.generate_subsample(
+                    subsample_count,
+                    random_seed,
+                    SUBSAMPLE_V1
+                )
+
+                indices, events = self._original_selection(
+                    subsample_count,
+                    random_seed
+                )
+                self.assertLess(len(indices), EVENT_COUNT)
+                np.testing.assert_array_equal(
+                    self.sample.subsample_indices,
+                    indices
+                )
+                self.assertEqual(subsample.dtype, events.dtype)
+                np.testing.assert_array_equal(subsample, events)
+
+    def test_v2_subsample(self):
+        positive_indices = self._positive_indices()
+        self.assertLess(len(positive_indices), EVENT_COUNT)
+
+        for random_seed in [1, 2, 99]:
+            for subsample_count in [10, 1000, EVENT_COUNT]:
+                self.sample.generate_subsample(
+                    subsample_count,
+                    random_seed,
+                    SUBSAMPLE_V2
+                )
+
+                np.testing.assert_array_equal(
+                    self.sample.subsample_indices,
+                    draw_subsample(
+                        positive_indices,
+                        subsample_count,
+                        random_seed,
+                        SUBSAMPLE_V2
+                    )
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import json
+import shutil
+import tempfile
+import unittest
+import urlparse
+
+import numpy as np
+from reflowrestclient import utils
+
+import process_request
+from process_request import ProcessRequest
+from tests.http_server import StubServer
+
+PARENT_STAGE = 10
+
+
+def _components(sample_pk):
+    """
+    Returns the ReFlow 'data' list of a sample's parent stage components
+    """
+    rng = np.random.RandomState(sample_pk)
+    components = list()
+    for cluster in range(3):
+        channels = [3, 1, 2]
+        covariance = np.cov(rng.randn(3, 20))
+        lines = [','.join(str(c - 1) for c in channels)] + [
+            ','.join(repr(v) for v in row) for row in covariance
+        ]
+        components.append(
+            {
+                'cluster': str(cluster),
+                'weight': rng.rand(),
+                'covariance_matrix': '\n'.join(lines),
+                'parameters': [
+                    {'channel': c, 'location': rng.randn()}
+                    for c in reversed(channels)
+                ]
+            }
+        )
+
+    return components
+
+
+class ComponentsServer(StubServer):
+    """
+    Stand-in for the ReFlow sample cluster components API, counting the
+    requests made for each sample
+    """
+    def __init__(self):
+        StubServer.__init__(self, self._respond)
+        self.requests = dict()
+
+    def _respond(self, path):
+        query = urlparse.parse_qs(urlparse.urlparse(path).query)
+        if int(query['process_request'][0]) != PARENT_STAGE:
+            return None
+
+        sample_pk = int(query['sample'][0])
+        with self.lock:
+            self.requests[sample_pk] = self.requests.get(sample_pk, 0) + 1
+
+        body = json.dumps(_components(sample_pk))
+        return body, [('Content-Type', 'application/json')]
+
+
+class FakeSample(object):
+    def __init__(self, sample_id):
+        self.sample_id = sample_id
+
+
+class LoadParentComponentsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.components_cache_dir = process_request.COMPONENTS_CACHE_DIR
+        process_request.COMPONENTS_CACHE_DIR = \
+            self.directory + '/components/'
+
+        self.server = ComponentsServer()
+        self.server.start()
+
+        self.samples = [FakeSample(sample_pk) for sample_pk in range(1, 6)]
+
+    def tearDown(self):
+        self.server.stop()
+        process_request.COMPONENTS_CACHE_DIR = self.components_cache_dir
+        shutil.rmtree(self.directory)
+
+    def _create_process_request(self, process_request_id, options=None):
+        pr = ProcessRequest.__new__(ProcessRequest)
+        pr.host = self.server.host
+        pr.token = 'token'
+        pr.method = utils.METHOD['http']
+        pr.process_request_id = process_request_id
+        pr.parent_stage = PARENT_STAGE
+        pr.parent_components = dict()
+        pr.options = options or {'download_concurrency': 3}
+
+        return pr
+
+    def _assert_parsed(self, pr):
+        for s in self.samples:
+            expected = ProcessRequest._parse_parent_components(
+                _components(s.sample_id)
+            )
+            parsed = pr.parent_components[s.sample_id]
+
+            self.assertEqual(parsed['clusters'], [0, 1, 2])
+            self.assertEqual(parsed['indices'], [2, 0, 1])
+            self.assertEqual(parsed['weights'], expected['weights'])
+            np.testing.assert_array_equal(
+                parsed['locations'],
+                expected['locations']
+            )
+            np.testing.assert_array_equal(
+                parsed['covariances'],
+                expected['covariances']
+            )
+
+    def test_parse(self):
+        components = _components(1)
+        parsed = ProcessRequest._parse_parent_components(components)
+
+        for i, comp in enumerate(components):
+            locations = dict(
+                (p['channel'] - 1, p['location']) for p in comp['parameters']
+            )
+            self.assertEqual(
+                parsed['locations'][i],
+                [locations[c] for c in [2, 0, 1]]
+            )
+
+    def test_later_prs_use_cache(self):
+        first = self._create_process_request(1)
+        first._load_parent_components(self.samples)
+        self._assert_parsed(first)
+
+        second = self._create_process_request(2)
+        second._load_parent_components(self.samples)
+        self._assert_parsed(second)
+
+        self.assertEqual(
+            self.server.requests,
+            dict((s.sample_id, 1) for s in self.samples)
+        )
+
+    def test_cache_disabled(self):
+        for process_request_id in [1, 2]:
+            pr = self._create_process_request(
+                process_request_id,
+                {'download_concurrency': 3, 'components_cache_size': 0}
+            )
+            pr._load_parent_components(self.samples)
+            self._assert_parsed(pr)
+
+        self.assertEqual(
+            self.server.requests,
+            dict((s.sample_id, 2) for s in self.samples)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
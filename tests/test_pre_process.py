@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from fcs_header import FCSHeader
+from panel_index import PanelIndex
+from process_request import ProcessRequest
+from sample_models import Sample
+from subsampling import SUBSAMPLE_V1, SUBSAMPLE_V2
+from tests.fcs_files import write_fcs
+from tests.samples import sample_dict
+
+SITE_PANEL_ID = 1
+SAMPLE_COUNT = 5
+
+
+def _panel():
+    params = list()
+    for i, param_type in enumerate(['FSC', 'SSC', 'FL', 'FL', 'FL']):
+        params.append(
+            {
+                'fcs_number': i + 1,
+                'parameter_type': param_type,
+                'parameter_value_type': 'A',
+                'markers': [{'name': 'CD%d' % i}],
+                'fluorochrome': None
+            }
+        )
+
+    return {'parameters': params}
+
+
+class PreProcessConcurrencyTestCase(unittest.TestCase):
+    """
+    Pre-processing samples in a pool of processes must give the same
+    results as pre-processing them serially
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        # samples of different sizes, w/ some negative scatter events
+        rng = np.random.RandomState(0)
+        self.fcs_paths = dict()
+        for sample_pk in range(1, SAMPLE_COUNT + 1):
+            events = rng.uniform(-100, 1000, (1000 * sample_pk, 5))
+            fcs_path = os.path.join(self.directory, '%d.fcs' % sample_pk)
+            write_fcs(fcs_path, events)
+            self.fcs_paths[sample_pk] = fcs_path
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _pre_process(self, concurrency, subsample_mode):
+        pr = ProcessRequest.__new__(ProcessRequest)
+        pr.host = 'localhost'
+        pr.process_request_id = concurrency
+        pr.directory = os.path.join(self.directory, str(concurrency))
+        pr.options = {
+            'preprocess_concurrency': concurrency,
+            'subsample_cache_size': 0,
+            'transformed_cache_size': 0
+        }
+        pr.parent_stage = None
+        pr.transformation = 'logicle'
+        pr.random_seed = 123
+        pr.subsample_count = 2000
+        pr.subsample_mode = subsample_mode
+        pr.panel_indices = {SITE_PANEL_ID: PanelIndex(_panel())}
+        pr.panel_maps = {SITE_PANEL_ID: [4, 2]}
+
+        compensation = np.vstack([[3, 4, 5], np.eye(3) + 0.1])
+        pr.samples = list()
+        for sample_pk, fcs_path in sorted(self.fcs_paths.items()):
+            s = Sample(
+                pr,
+                sample_dict(sample_pk, 'sha1', SITE_PANEL_ID),
+                compensation
+            )
+            s.fcs_path = fcs_path
+            s.fcs_header = FCSHeader(fcs_path)
+            pr.samples.append(s)
+
+        pr._pre_process(pr.samples)
+
+        return pr.samples
+
+    def test_same_results(self):
+        for subsample_mode in [SUBSAMPLE_V1, SUBSAMPLE_V2]:
+            serial = self._pre_process(1, subsample_mode)
+            pooled = self._pre_process(4, subsample_mode)
+
+            for s1, s2 in zip(serial, pooled):
+                self.assertNotEqual(s1.preprocessed_path, s2.preprocessed_path)
+                np.testing.assert_array_equal(
+                    s1.subsample_indices,
+                    s2.subsample_indices
+                )
+                np.testing.assert_array_equal(
+                    np.load(s1.preprocessed_path),
+                    np.load(s2.preprocessed_path)
+                )
+                np.testing.assert_array_equal(
+                    np.load(s1.normalized_path),
+                    np.load(s2.normalized_path)
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import process_request
+from process_request import ProcessRequest
+
+HOST = 'localhost'
+PROCESS_REQUEST_ID = 5
+
+
+class StateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = process_request.CACHE_DIR
+        process_request.CACHE_DIR = self.directory + '/'
+
+        # same as the daemon
+        self.umask = os.umask(0)
+
+        self.pr = ProcessRequest.__new__(ProcessRequest)
+        self.pr.host = HOST
+        self.pr.token = 'secret-token'
+        self.pr.process_request_id = PROCESS_REQUEST_ID
+        self.pr.directory = ProcessRequest.get_directory(
+            HOST,
+            PROCESS_REQUEST_ID
+        )
+
+    def tearDown(self):
+        os.umask(self.umask)
+        process_request.CACHE_DIR = self.cache_dir
+        shutil.rmtree(self.directory)
+
+    def _state_path(self):
+        return self.pr.directory + '/state.pkl'
+
+    def test_private_state(self):
+        self.pr.save_state()
+
+        directory_mode = stat.S_IMODE(os.stat(self.pr.directory).st_mode)
+        self.assertEqual(directory_mode, 0700)
+        state_mode = stat.S_IMODE(os.stat(self._state_path()).st_mode)
+        self.assertEqual(state_mode, 0600)
+        self.assertNotIn('secret-token', open(self._state_path()).read())
+
+        loaded = ProcessRequest.load_state(
+            HOST,
+            PROCESS_REQUEST_ID,
+            'new-token'
+        )
+        self.assertEqual(loaded.token, 'new-token')
+        self.assertEqual(loaded.process_request_id, PROCESS_REQUEST_ID)
+        self.assertEqual(self.pr.token, 'secret-token')
+
+    def test_unsafe_state_rejected(self):
+        self.pr.save_state()
+        os.chmod(self._state_path(), 0666)
+
+        self.assertRaises(
+            ValueError,
+            ProcessRequest.load_state,
+            HOST,
+            PROCESS_REQUEST_ID,
+            'new-token'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from sample_cache import SampleCache
+
+
+def _dead_pid():
+    """
+    Returns the PID of a process that has exited
+    """
+    process = subprocess.Popen(['true'])
+    process.wait()
+
+    return process.pid
+
+
+class SampleCacheTempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = SampleCache(self.directory + '/', 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stale_temp_dirs_removed(self):
+        stale_dir = os.path.join(self.directory, 'tmp', str(_dead_pid()))
+        os.makedirs(stale_dir)
+        open(os.path.join(stale_dir, '1.fcs'), 'wb').close()
+
+        own_dir = self.cache.temp_dir()
+        open(os.path.join(own_dir, '2.fcs'), 'wb').close()
+
+        self.cache.release('missing', 'owner')
+
+        self.assertFalse(os.path.exists(stale_dir))
+        self.assertTrue(os.path.exists(os.path.join(own_dir, '2.fcs')))
+
+
+class SampleCacheModeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.umask = os.umask(0)
+
+    def tearDown(self):
+        os.umask(self.umask)
+        shutil.rmtree(self.directory)
+
+    def test_private_directories(self):
+        cache_dir = os.path.join(self.directory, 'cache')
+        os.makedirs(os.path.join(cache_dir, 'locks'), 0777)
+
+        cache = SampleCache(cache_dir + '/', 1024)
+
+        for d in [cache_dir, cache.lock_dir, cache.temp_dir()]:
+            self.assertEqual(os.stat(d).st_mode & 0777, 0700)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+import numpy as np
+
+from subsampling import draw_subsample, SUBSAMPLE_V1, SUBSAMPLE_V2
+
+
+class DrawSubsampleTestCase(unittest.TestCase):
+    # A mode's output must never change for a given seed, see SUBSAMPLE_MODES
+    def test_v1_output(self):
+        candidates = np.arange(100, 200)
+
+        expected = np.arange(100, 200)
+        rng = np.random.RandomState()
+        rng.seed(123)
+        rng.shuffle(expected)
+
+        np.testing.assert_array_equal(
+            draw_subsample(candidates, 10, 123, SUBSAMPLE_V1),
+            expected[:10]
+        )
+
+    def test_v2_output(self):
+        np.testing.assert_array_equal(
+            draw_subsample(np.arange(100, 200), 10, 123, SUBSAMPLE_V2),
+            [169, 129, 124, 156, 173, 145, 198, 170, 152, 144]
+        )
+
+    def test_v2_nearly_all_candidates(self):
+        candidates = np.arange(200000)
+
+        subsample = draw_subsample(candidates, 199999, 7, SUBSAMPLE_V2)
+
+        self.assertEqual(len(np.unique(subsample)), 199999)
+        np.testing.assert_array_equal(candidates, np.arange(200000))
+
+    def test_v2_all_candidates(self):
+        subsample = draw_subsample(np.arange(50), 100, 7, SUBSAMPLE_V2)
+
+        np.testing.assert_array_equal(np.sort(subsample), np.arange(50))
+
+
+if __name__ == '__main__':
+    unittest.main()